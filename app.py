@@ -1,17 +1,36 @@
 import os
+import json
+import base64
+import hashlib
+import time
 import datetime
-from flask import Flask, request, abort, jsonify
+from urllib.parse import urlencode
+from flask import Flask, Response, request, abort, jsonify, stream_with_context, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Actor, Gender, Movie
+from models import db, setup_db, Actor, Gender, Movie, ResourceVersion, count_rows, \
+    get_existing_ids, get_missing_ids, get_related_rows, update_association_ids, association_table, \
+    mark_changed, commit_write, run_write, add_change_listener, use_replica, get_replica, replica_binds, \
+    PoolMetrics, POOL_METRICS, READ_YOUR_WRITES, GROUP_COMMITTER, READ_MODELS
+import models
 
 from auth import AuthError, requires_auth
+from cache import RESPONSE_CACHE, ITEM_CACHE
+from metrics import METRICS, CollectedHistogram, Gauge, TimedJSONEncoder, \
+    start_request, end_request, timed
+from serialize import dumps, dumps_with_list
+from profiling import RequestProfiler
+
+# drop the cached items once a write to them is committed, the cached
+# responses are keyed by the version of the resource in the database
+add_change_listener(ITEM_CACHE.invalidate)
 
 def create_app():
   # create and configure the app
 
   #print(__name__)
   app = Flask(__name__)
+  app.json_encoder = TimedJSONEncoder
   CORS(app)
   #setup_db(app, os.getenv('SQLALCHEMY_DATABASE_URI'))
   #setup_db(app, os.getenv('DATABASE_URI'))
@@ -26,6 +45,46 @@ def create_app():
 #APP = create_app(os.environ['DATABASE_URL'], test=False)
 APP = create_app()
 
+#
+# Read replica routing. GET requests read from a replica unless the client
+# wrote within the read-your-writes window, remembered by this worker per
+# token and, for the other workers, in a cookie
+#
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PRIMARY_COOKIE = 'db_primary_until'
+
+def client_key():
+  client = request.headers.get('Authorization') or request.remote_addr or ''
+  return hashlib.sha256(client.encode()).hexdigest()
+
+def wrote_recently():
+  try:
+    if float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time():
+      return True
+  except ValueError:
+    pass
+  return READ_YOUR_WRITES.recent(client_key())
+
+def settled(age):
+  # whether data read now is past the replication lag of a change age seconds old
+  return get_replica() is None or age >= READ_YOUR_WRITES.window
+
+@APP.before_request
+def route_reads():
+  if request.method in READ_METHODS and not wrote_recently():
+    use_replica()
+
+@APP.after_request
+def remember_writes(response):
+  # without replicas every read is on the primary, nothing to remember
+  if not replica_binds(APP):
+    return response
+  if request.method not in READ_METHODS and response.status_code < 400:
+    window = READ_YOUR_WRITES.record(client_key())
+    response.set_cookie(PRIMARY_COOKIE, str(int(time.time() + window) + 1),
+                        max_age=int(window) + 1, httponly=True)
+  return response
+
 @APP.route('/', methods=['GET'])
 def check_health():
   #
@@ -35,50 +94,633 @@ def check_health():
   return jsonify({
       'success': True,
       'healthy': True,
-      'db': os.environ['DATABASE_URL']
+      'db': os.environ['DATABASE_URL'],
       #'path': os.environ['DATABASE_URL']
+      'response_cache': RESPONSE_CACHE.stats(),
+      'item_cache': ITEM_CACHE.stats(),
+      'db_pool': {bind: stats.stats() for bind, stats in list(POOL_METRICS.items())},
   })
 
-@APP.route('/actors', methods=['GET'])
-@requires_auth('get:actors')
-def get_actors(payload):
+#
+# Request metrics, observed per route once the response is built
+#
+@APP.before_request
+def start_request_metrics():
+  start_request()
+
+@APP.after_request
+def end_request_metrics(response):
+  route = request.url_rule.rule if request.url_rule else 'unmatched'
+  end_request(route, request.method, response.status_code)
+  return response
+
+def pool_wait_buckets():
+  return [((bind,), list(stats.wait_buckets), stats.wait_sum, stats.checkouts)
+          for bind, stats in list(POOL_METRICS.items())]
+
+def pool_timeouts():
+  return [((bind,), stats.timeouts) for bind, stats in list(POOL_METRICS.items())]
+
+def pool_gauges():
+  gauges = []
+  for bind, metrics in list(POOL_METRICS.items()):
+    stats = metrics.stats()
+    gauges.extend(((bind, state), stats[state]) for state in ('in_use', 'idle', 'size', 'overflow')
+                  if state in stats)
+  return gauges
+
+def cache_counts():
+  return [((name, result), cache.stats()[result])
+          for name, cache in (('response', RESPONSE_CACHE), ('item', ITEM_CACHE))
+          for result in ('hits', 'misses')]
+
+METRICS.register(CollectedHistogram(
+    'capstone_db_pool_wait_seconds', 'Time to check a connection out of the pool.',
+    ['bind'], buckets=PoolMetrics.BUCKETS, collect=pool_wait_buckets))
+METRICS.register(Gauge(
+    'capstone_db_pool_timeouts_total', 'Checkouts that timed out waiting for a connection.',
+    ['bind'], pool_timeouts, type='counter'))
+METRICS.register(Gauge(
+    'capstone_db_pool_connections', 'Connections of the pool by state.',
+    ['bind', 'state'], pool_gauges))
+METRICS.register(Gauge(
+    'capstone_db_group_commit_total', 'Transactions committed by the group commit and the writes they held.',
+    ['kind'], lambda: [((kind,), n) for kind, n in GROUP_COMMITTER.stats().items()],
+    type='counter'))
+METRICS.register(Gauge(
+    'capstone_cache_requests_total', 'Cache lookups by cache and result.',
+    ['cache', 'result'], cache_counts, type='counter'))
+
+@APP.route('/metrics', methods=['GET'])
+def get_metrics():
+  #
+  # Prometheus scrape endpoint, without authentication as check_health
+  #
+
+  return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+#
+# Profiles of slow and sampled requests, kept by the profiler middleware
+#
+PROFILER = RequestProfiler(APP.wsgi_app)
+APP.wsgi_app = PROFILER
+
+@APP.route('/profiles', methods=['GET'])
+@requires_auth('get:profiles')
+def get_profiles(payload):
+  #
+  # Endpoint to list the kept profiles, newest first, requires get:profiles permission
+  #
+
+  return jsonify({
+      'profiles': PROFILER.list(),
+      'success': True,
+  })
+
+@APP.route('/profiles/<int:profile_id>', methods=['GET'])
+@requires_auth('get:profiles')
+def get_profile(payload, profile_id):
   #
-  # Endpoint to get the list of actors, requires get:actors permission
+  # Endpoint to download one profile as format=collapsed (default) stacks
+  # or format=pstats, requires get:profiles permission
   #
 
+  profile_format = request.args.get('format', 'collapsed')
+  if profile_format not in ('collapsed', 'pstats'):
+    abort(400)
+  profile = PROFILER.get(profile_id)
+  if profile is None or (profile_format == 'pstats' and profile.stats is None):
+    abort(404)
+
+  if profile_format == 'pstats':
+    body, mimetype = profile.pstats(), 'application/octet-stream'
+  else:
+    body, mimetype = profile.collapsed(), 'text/plain'
+  return Response(body, mimetype=mimetype, headers={
+      'Content-Disposition': f'attachment; filename=profile-{profile_id}.{profile_format}'})
+
+#
+# Keyset pagination of the list endpoints. The cursor is the last id of
+# the previous page, encoded so that clients treat it as opaque
+#
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(last_id):
+  return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode()
+
+def decode_cursor(cursor):
   try:
-    ans = Actor.query.all()
-    formatted_ans = []
-    for i in ans:
-      formatted_ans.append(i.format())
+    return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))['id'])
+  except:
+    # malformed cursor
+    abort(400)
+
+def get_page_args(args=None):
+  #
+  # Return (limit, after_id) from the query string, limit is None if the
+  # client does not ask for paging
+  #
+  args = request.args if args is None else args
+  cursor = args.get('cursor')
+  if 'limit' not in args and cursor is None:
+    return None, None
+
+  limit = DEFAULT_PAGE_SIZE
+  if 'limit' in args:
+    limit = args.get('limit', type=int)
+    if limit is None or limit < 1:
+      abort(400)
+  limit = min(limit, MAX_PAGE_SIZE)
+  after_id = decode_cursor(cursor) if cursor is not None else None
+  return limit, after_id
+
+def get_total_arg(args=None):
+  args = request.args if args is None else args
+  total = args.get('total')
+  if total not in (None, 'exact', 'estimate'):
+    abort(400)
+  return total
+
+#
+# Filters of the list endpoints, pushed down into the WHERE clause. Ranges
+# are inclusive, dates are YYYYMMDD as in the bodies. The name and title
+# searches ignore case and are served by the trigram indexes
+#
+def like_escape(value):
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def parse_date(value):
+  return datetime.datetime.strptime(value, '%Y%m%d').date()
+
+FILTERS = {
+    'actor': {
+        'age_min': lambda v: Actor.age >= int(v),
+        'age_max': lambda v: Actor.age <= int(v),
+        'gender': lambda v: Actor.gender == Gender(v),
+        'name_prefix': lambda v: Actor.name.ilike(like_escape(v) + '%', escape='\\'),
+        'name_contains': lambda v: Actor.name.ilike('%' + like_escape(v) + '%', escape='\\'),
+    },
+    'movie': {
+        'date_release_from': lambda v: Movie.date_release >= parse_date(v),
+        'date_release_to': lambda v: Movie.date_release <= parse_date(v),
+        'title_prefix': lambda v: Movie.title.ilike(like_escape(v) + '%', escape='\\'),
+        'title_contains': lambda v: Movie.title.ilike('%' + like_escape(v) + '%', escape='\\'),
+    },
+}
+FILTER_ARGS = {arg for filters in FILTERS.values() for arg in filters}
+
+def get_filters(model, args=None):
+  #
+  # Return the list of conditions asked for in the query string
+  #
+  args = request.args if args is None else args
+  conditions = []
+  for arg, condition in FILTERS[model.__tablename__].items():
+    value = args.get(arg)
+    if value is None:
+      continue
+    try:
+      conditions.append(condition(value))
+    except ValueError:
+      # malformed number, date or gender
+      abort(400)
+  return conditions
+
+def list_query(model, conditions=()):
+  return db.session.query(*model.columns()).filter(*conditions).order_by(model.id)
+
+def list_page(model, limit, after_id, conditions=()):
+  #
+  # Return the rows of the page, as tuples of model.columns(), and the
+  # cursor of the next one, next cursor is None on the last page
+  #
+  query = list_query(model, conditions)
+  if after_id is not None:
+    query = query.filter(model.id > after_id)
+  if limit is None:
+    return query.all(), None
+
+  rows = query.limit(limit + 1).all()
+  if len(rows) > limit:
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][0])
+  return rows, None
+
+def use_read_model(conditions):
+  #
+  # The read model serves the unfiltered lists only
+  #
+  return models.READ_MODEL and not conditions
+
+def doc_page(model, limit, after_id):
+  #
+  # Same as list_page with the serialized items, as bytes, read from the
+  # read model by its primary key
+  #
+  table = READ_MODELS[f'{model.__tablename__}s'][1]
+  query = db.session.query(table.c.id, table.c.doc).order_by(table.c.id)
+  if after_id is not None:
+    query = query.filter(table.c.id > after_id)
+  if limit is None:
+    return [row[1].encode() for row in query], None
+
+  rows = query.limit(limit + 1).all()
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1][0])
+  return [row[1].encode() for row in rows], next_cursor
+
+def json_response(data):
+  #
+  # Same response as jsonify(data), encoded by serialize.dumps. jsonify is
+  # kept when the app pretty prints
+  #
+  if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+    return jsonify(data)
+  with timed('serialize'):
+    body = dumps(data) + b'\n'
+  return Response(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+def docs_response(key, docs, data):
+  #
+  # json_response of data with the serialized items under key, joined
+  # without decoding them unless the app pretty prints
+  #
+  if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug:
+    return jsonify({key: [json.loads(doc) for doc in docs], **data})
+  with timed('serialize'):
+    body = dumps_with_list(key, docs, data) + b'\n'
+  return Response(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+#
+# Streaming export of a whole table. Rows come from a server side cursor
+# and are serialized a batch at a time, so the worker memory does not grow
+# with the table and the first bytes go out before the last row is read
+#
+STREAM_BATCH_SIZE = 1000
+
+def stream_batches(model, conditions):
+  query = list_query(model, conditions).yield_per(STREAM_BATCH_SIZE)
+  batch = []
+  for row in query:
+    batch.append(row)
+    if len(batch) == STREAM_BATCH_SIZE:
+      yield model.format_rows(batch)
+      batch = []
+  if batch:
+    yield model.format_rows(batch)
+
+def stream_docs(model):
+  table = READ_MODELS[f'{model.__tablename__}s'][1]
+  query = db.session.query(table.c.doc).order_by(table.c.id).yield_per(STREAM_BATCH_SIZE)
+  batch = []
+  for doc, in query:
+    batch.append(doc.encode())
+    if len(batch) == STREAM_BATCH_SIZE:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def stream_ndjson(model, conditions):
+  if use_read_model(conditions):
+    for batch in stream_docs(model):
+      yield b''.join(doc + b'\n' for doc in batch)
+    return
+  for batch in stream_batches(model, conditions):
+    yield b''.join(dumps(i) + b'\n' for i in batch)
+
+def stream_json(model, key, conditions):
+  yield f'{{"{key}":['.encode()
+  first = True
+  if use_read_model(conditions):
+    chunks = (b','.join(batch) for batch in stream_docs(model))
+  else:
+    # the items of the batch without the brackets of the list
+    chunks = (dumps(batch)[1:-1] for batch in stream_batches(model, conditions))
+  for chunk in chunks:
+    yield chunk if first else b',' + chunk
+    first = False
+  yield b'],"success":true}\n'
+
+def stream_response(model, key, stream, conditions):
+  if stream == 'ndjson':
+    return Response(stream_with_context(stream_ndjson(model, conditions)),
+                    mimetype='application/x-ndjson')
+  if stream == 'json':
+    return Response(stream_with_context(stream_json(model, key, conditions)),
+                    mimetype='application/json')
+  abort(400)
+
+def list_response(model, key):
+  conditions = get_filters(model)
+  stream = request.args.get('stream')
+  if stream is not None:
+    return stream_response(model, key, stream, conditions)
+
+  limit, after_id = get_page_args()
+  total = get_total_arg()
+  docs = None
+  try:
+    if use_read_model(conditions):
+      docs, next_cursor = doc_page(model, limit, after_id)
+    else:
+      rows, next_cursor = list_page(model, limit, after_id, conditions)
+      formatted_ans = model.format_rows(rows)
+    # unpaged lists carry their length as total, nothing to count
+    if total is not None and limit is not None:
+      total = count_rows(model, estimate=(total == 'estimate'), conditions=conditions)
   except:
     abort(422)
-  return jsonify({
-          'actors': formatted_ans,
-          'total_actors': len(formatted_ans),
-          'success': True,
-  })
+
+  ans = {
+      'success': True,
+  }
+  if limit is None:
+    ans[f'total_{key}'] = len(formatted_ans if docs is None else docs)
+  else:
+    ans['next_cursor'] = next_cursor
+    if total is not None:
+      ans[f'total_{key}'] = total
+  if docs is not None:
+    return docs_response(key, docs, ans)
+  ans[key] = formatted_ans
+  return json_response(ans)
+
+def cached_response(resource, version, build):
+  #
+  # Serve a list response from the response cache, build and store it on a
+  # miss. The key holds the version of the resource in the database, read
+  # before building, so every worker stops reading an entry once a write is
+  # committed, and a write committed in the meantime makes the stored entry
+  # unreachable instead of stale
+  #
+  if 'stream' in request.args or not RESPONSE_CACHE.enabled():
+    return build()
+
+  key = RESPONSE_CACHE.key(resource, version, urlencode(sorted(request.args.items(multi=True))))
+  body = RESPONSE_CACHE.get(key)
+  if body is not None:
+    return Response(body, mimetype='application/json', headers={'X-Cache': 'HIT'})
+
+  response = build()
+  if response.status_code == 200:
+    RESPONSE_CACHE.set(key, response.get_data())
+  response.headers['X-Cache'] = 'MISS'
+  return response
+
+def make_etag(resource, version, path, args):
+  variant = f'{path}?{urlencode(sorted(args.items(multi=True)))}'
+  return f'{resource}-{version}-{hashlib.sha1(variant.encode()).hexdigest()[:16]}'
+
+def make_last_modified(updated_at):
+  #
+  # Naive UTC datetime in whole seconds, as HTTP dates have no fraction
+  #
+  if updated_at is None:
+    return None
+  if updated_at.tzinfo is not None:
+    updated_at = updated_at.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+  return updated_at.replace(microsecond=0)
+
+def is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+  if if_none_match:
+    return if_none_match.contains(etag)
+  if if_modified_since is None or last_modified is None:
+    return False
+  # a change within the current second may be followed by another one in
+  # the same second, which the whole second dates can not tell apart
+  now = datetime.datetime.utcnow().replace(microsecond=0)
+  return last_modified < now and last_modified <= if_modified_since
+
+def conditional_response(resource, build):
+  #
+  # Conditional GET on the change version of the resource. The ETag comes
+  # from the version, the path and the query string, not from the body, so
+  # a matching If-None-Match is answered with 304 without building it.
+  # build is called with the version
+  #
+  try:
+    version, updated_at = ResourceVersion.get(resource)
+  except:
+    abort(422)
+  etag = make_etag(resource, version, request.path, request.args)
+  last_modified = make_last_modified(updated_at)
+  not_modified = is_not_modified(etag, last_modified, request.if_none_match,
+                                 request.if_modified_since)
+
+  if not_modified:
+    response = Response(status=304)
+  else:
+    response = build(version)
+    if response.status_code != 200:
+      return response
+  response.set_etag(etag)
+  if last_modified is not None:
+    response.last_modified = last_modified
+  return response
+
+@APP.route('/actors', methods=['GET'])
+@requires_auth('get:actors')
+def get_actors(payload):
+  #
+  # Endpoint to get the list of actors, requires get:actors permission.
+  # Paged by limit and cursor if given, total=exact|estimate adds the count,
+  # stream=ndjson|json streams the whole table
+  #
+
+  return conditional_response('actors', lambda version: cached_response(
+      'actors', version, lambda: list_response(Actor, 'actors')))
 
 @APP.route('/movies', methods=['GET'])
 @requires_auth('get:movies')
 def get_movies(payload):
   #
-  # Endpoint to get the list of movies, requires get:movies permission
+  # Endpoint to get the list of movies, requires get:movies permission.
+  # Paged by limit and cursor if given, total=exact|estimate adds the count,
+  # stream=ndjson|json streams the whole table
+  #
+
+  return conditional_response('movies', lambda version: cached_response(
+      'movies', version, lambda: list_response(Movie, 'movies')))
+
+def item_response(model, key, resource, item_id):
+  #
+  # Return one actor or movie from the item cache, or load it with its
+  # relationship ids in one grouped query and cache it. The entries are
+  # evicted by id when a write changes them, the resource version is only
+  # checked for the ETag, so a write to another row keeps the entry
+  #
+  item = ITEM_CACHE.get(resource, item_id)
+  if item is None:
+    generation = ITEM_CACHE.generation(resource)
+    try:
+      rows = db.session.query(*model.columns()).filter(model.id == item_id).all()
+      if rows:
+        item = model.format_rows(rows)[0]
+    except:
+      abort(422)
+    if item is None:
+      abort(404)
+    if settled(ITEM_CACHE.age(resource)):
+      ITEM_CACHE.set(resource, item_id, item, generation)
+  return json_response({
+      key: item,
+      'success': True,
+  })
+
+@APP.route('/actors/<int:actor_id>', methods=['GET'])
+@requires_auth('get:actors')
+def get_actor(payload, actor_id):
+  #
+  # Endpoint to get one actor, requires get:actors permission
+  #
+
+  return conditional_response('actors',
+      lambda version: item_response(Actor, 'actor', 'actors', actor_id))
+
+@APP.route('/movies/<int:movie_id>', methods=['GET'])
+@requires_auth('get:movies')
+def get_movie(payload, movie_id):
+  #
+  # Endpoint to get one movie, requires get:movies permission
+  #
+
+  return conditional_response('movies',
+      lambda version: item_response(Movie, 'movie', 'movies', movie_id))
+
+#
+# Related objects of actors and movies, read with one join over the
+# association table. The key of the parent in the association, the key of
+# the related model and the related model, by parent table
+#
+RELATIONS = {
+    'actor': (association_table.c.actor_id, association_table.c.movie_id, Movie),
+    'movie': (association_table.c.movie_id, association_table.c.actor_id, Actor),
+}
+
+def get_ids_arg(args=None):
+  #
+  # Return the distinct ids of the comma separated ids argument
   #
+  args = request.args if args is None else args
+  try:
+    ids = [int(i) for i in args.get('ids', '').split(',')]
+  except ValueError:
+    abort(400)
+  if len(ids) > MAX_PAGE_SIZE:
+    abort(400)
+  return list(dict.fromkeys(ids))
 
+def related_response(model, key, item_id):
+  #
+  # Return a page of the related objects of one actor or movie, paged and
+  # filtered as the list endpoints
+  #
+  parent_key, related_key, related = RELATIONS[model.__tablename__]
+  conditions = get_filters(related)
+  limit, after_id = get_page_args()
+  next_cursor = None
   try:
-    ans = Movie.query.all()
-    formatted_ans = []
-    for i in ans:
-      formatted_ans.append(i.format())
+    rows = get_related_rows(parent_key, related_key, related, [item_id], conditions,
+                            after_id, None if limit is None else limit + 1)
+    if limit is not None and len(rows) > limit:
+      rows = rows[:limit]
+      next_cursor = encode_cursor(rows[-1][1])
+    # an empty page may be of an actor or movie that does not exist
+    found = bool(rows) or bool(get_existing_ids(model, [item_id]))
+    items = related.format_rows([row[1:] for row in rows])
   except:
     abort(422)
-  return jsonify({
-          'movies': formatted_ans,
-          'total_movies': len(formatted_ans),
-          'success': True,
+  if not found:
+    abort(404)
+
+  ans = {
+      key: items,
+      'success': True,
+  }
+  if limit is None:
+    ans[f'total_{key}'] = len(items)
+  else:
+    ans['next_cursor'] = next_cursor
+  return json_response(ans)
+
+def related_batch_response(model, key):
+  #
+  # Return the related objects of many actors or movies by id, all read
+  # with the same join whatever the number of ids. 404 if one is missing
+  #
+  parent_key, related_key, related = RELATIONS[model.__tablename__]
+  ids = get_ids_arg()
+  conditions = get_filters(related)
+  try:
+    missing = get_missing_ids(model, ids)
+    if not missing:
+      rows = get_related_rows(parent_key, related_key, related, ids, conditions)
+      # a related object shared by several parents is formatted once
+      unique = {row[1]: row[1:] for row in rows}
+      items = dict(zip(unique, related.format_rows(list(unique.values()))))
+      grouped = {str(id): [] for id in ids}
+      for row in rows:
+        grouped[str(row[0])].append(items[row[1]])
+  except:
+    abort(422)
+  if missing:
+    abort_missing('ids', missing)
+  return json_response({
+      key: grouped,
+      'success': True,
   })
 
+@APP.route('/actors/<int:actor_id>/movies', methods=['GET'])
+@requires_auth('get:movies')
+def get_actor_movies(payload, actor_id):
+  #
+  # Endpoint to get the movies of one actor, requires get:movies permission
+  #
+
+  return related_response(Actor, 'movies', actor_id)
+
+@APP.route('/movies/<int:movie_id>/actors', methods=['GET'])
+@requires_auth('get:actors')
+def get_movie_actors(payload, movie_id):
+  #
+  # Endpoint to get the actors of one movie, requires get:actors permission
+  #
+
+  return related_response(Movie, 'actors', movie_id)
+
+@APP.route('/actors/movies', methods=['GET'])
+@requires_auth('get:movies')
+def get_actors_movies(payload):
+  #
+  # Endpoint to get the movies of the actors of ids=1,2,3 by actor id,
+  # requires get:movies permission
+  #
+
+  return related_batch_response(Actor, 'movies')
+
+@APP.route('/movies/actors', methods=['GET'])
+@requires_auth('get:actors')
+def get_movies_actors(payload):
+  #
+  # Endpoint to get the actors of the movies of ids=1,2,3 by movie id,
+  # requires get:actors permission
+  #
+
+  return related_batch_response(Movie, 'actors')
+
+def delete_item(model, item_id):
+  #
+  # Delete the actor or movie, return False if it does not exist
+  #
+  item = model.query.filter(model.id == item_id).one_or_none()
+  if item:
+    item.delete()
+  return item is not None
+
 @APP.route('/actors/<int:actor_id>', methods=['DELETE'])
 @requires_auth('delete:actor')
 def delete_actor(payload, actor_id):
@@ -87,20 +729,12 @@ def delete_actor(payload, actor_id):
   #
 
   try:
-    actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+    found = run_write(lambda: delete_item(Actor, actor_id))
   except:
     # processing error
     abort(422)
-  if actor:
-    #print('if')
-    try:
-      actor.delete()
-    except:
-      # processing error
-      abort(422)
-  else:
+  if not found:
     # actor not found
-    #print('else')
     abort(404)
   return jsonify({
             'actor_id': actor_id,
@@ -115,39 +749,42 @@ def delete_movie(payload, movie_id):
   #
 
   try:
-    movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+    found = run_write(lambda: delete_item(Movie, movie_id))
   except:
     # processing error
     abort(422)
-  if movie:
-    #print('if')
-    try:
-      movie.delete()
-    except:
-      # processing error
-      abort(422)
-  else:
+  if not found:
     # movie not found
-    #print('else')
     abort(404)
   return jsonify({
             'movie_id': movie_id,
             'success': True,
   })
 
+def abort_missing(key, missing):
+  #
+  # Abort with 404, the referenced ids which do not exist are listed under
+  # missing_<key> as in the results of the bulk endpoints
+  #
+  response = jsonify({
+      'success': False,
+      'error': 404,
+      'message': 'resource not found',
+      f'missing_{key}': missing,
+  })
+  response.status_code = 404
+  abort(response)
+
 def check_movies_exist(movies_id):
   #
-  # Called by add_actor enpoint, check the list of movies provided. Return the Movies objects if all exists, 
-  # otherwise return None
+  # Called by add_actor enpoint, check the list of movies provided. Only the ids
+  # are read, return the ids of the movies which do not exist
   #  
 
-  movies = Movie.query.filter(Movie.id.in_(movies_id)).all()
-  #print(movies_id)
-  #print(movies)
-  if len(movies) == len(movies_id):
-    return movies
-  else:
-    return None 
+  try:
+    return get_missing_ids(Movie, movies_id)
+  except:
+    abort(422)
 
 @APP.route('/actors', methods=['POST'])
 @requires_auth('post:actor')
@@ -172,37 +809,39 @@ def add_actor(payload):
     abort(400)
   else:
     # determine all the movies exist
-    movies = check_movies_exist(movies_id)
-    #print(movies)
-    if movies is not None or movies_id == []:
+    missing = check_movies_exist(movies_id)
+    if not missing:
       try:
-        #print(f'{name} {age} {gender} {movies}')
-        actor = Actor(name=name, age=age, gender=Gender(gender))
-        actor.movies = movies
-        actor.insert()
+        # the association rows are written from the ids, no movie is loaded
+        actor = {
+            'name': name,
+            'age': age,
+            'gender': Gender(gender),
+            'movies_id': movies_id,
+        }
+        actor_id, = run_write(lambda: Actor.bulk_insert([actor]))
       except:
         # processing error
         abort(422)
     else:
       # input error, some or all movies do not exist
-      abort(404)
+      abort_missing('movies_id', missing)
 
   return jsonify({
         'success': True,
-        'actor_id': actor.id,
+        'actor_id': actor_id,
   })
 
 def check_actors_exist(actors_id):
   #
-  # Call by add_movie endpoint, it checks for the existence of the list actors_id,
-  # return Actor objects if all exist, otherwise return None
+  # Call by add_movie endpoint, it checks for the existence of the list actors_id.
+  # Only the ids are read, return the ids of the actors which do not exist
   #  
 
-  actors = Actor.query.filter(Actor.id.in_(actors_id)).all()
-  if len(actors) == len(actors_id):
-    return actors
-  else:
-    return None
+  try:
+    return get_missing_ids(Actor, actors_id)
+  except:
+    abort(422)
 
 @APP.route('/movies', methods=['POST'])
 @requires_auth('post:movie')
@@ -226,125 +865,279 @@ def add_movie(payload):
     abort(400)
   else:
     # determine all the actors exist
-    actors = check_actors_exist(actors_id)
-    if actors:
+    missing = check_actors_exist(actors_id)
+    if not missing:
       try:
         date_release = datetime.datetime.strptime(date_release, '%Y%m%d').date()
-        #print(f'{title} {date_release} {actors_id} {actors}')
-        movie = Movie(title=title, date_release=date_release, actors=actors)
-        movie.insert()
+        # the association rows are written from the ids, no actor is loaded
+        movie = {
+            'title': title,
+            'date_release': date_release,
+            'actors_id': actors_id,
+        }
+        movie_id, = run_write(lambda: Movie.bulk_insert([movie]))
       except:
         # processing error
         abort(422)
     else:
       # input error, some or all actors do not exist
-      abort(404)
+      abort_missing('actors_id', missing)
 
   return jsonify({
       'success': True,
-      'movie_id': movie.id,
+      'movie_id': movie_id,
   })
 
-@APP.route('/actors/<int:actor_id>', methods=['PATCH'])
-@requires_auth('patch:actor')
-def update_actor(payload, actor_id):
+#
+# Bulk create endpoints. The body is an array of the same objects taken by
+# POST /actors and POST /movies. The referenced ids of all items are checked
+# with one query and the valid items are inserted in one transaction, the
+# response holds the new id or the error of every item in the same order
+#
+MAX_BULK_SIZE = 10000
+
+def is_int(value):
+  return isinstance(value, int) and not isinstance(value, bool)
+
+def is_id_list(value):
+  return isinstance(value, list) and all(is_int(i) for i in value)
+
+def parse_bulk_actor(item):
   #
-  # Endpoint to update actor. name, age, gender must be provided. movies_id is optional,
-  # if provided, endpoint will check the existence of them. Actor can only be updated 
-  # if all the movies_id exist
+  # Return the actor of a bulk item as dict, None if it is not valid
   #
-  body = request.get_json()
+  if not isinstance(item, dict):
+    return None
+  name = item.get('name')
+  age = item.get('age')
+  gender = item.get('gender')
+  movies_id = item.get('movies_id', [])
+  if not isinstance(name, str) or not is_int(age) or gender not in ('M', 'F') \
+      or not is_id_list(movies_id):
+    return None
+  return {
+      'name': name,
+      'age': age,
+      'gender': Gender(gender),
+      'movies_id': list(set(movies_id)),
+  }
 
-  if not body:
+def parse_bulk_movie(item):
+  #
+  # Return the movie of a bulk item as dict, None if it is not valid
+  #
+  if not isinstance(item, dict):
+    return None
+  title = item.get('title')
+  date_release = item.get('date_release')
+  actors_id = item.get('actors_id', [])
+  if not isinstance(title, str) or not isinstance(date_release, str) \
+      or not is_id_list(actors_id) or actors_id == []:
+    return None
+  try:
+    date_release = datetime.datetime.strptime(date_release, '%Y%m%d').date()
+  except ValueError:
+    return None
+  return {
+      'title': title,
+      'date_release': date_release,
+      'actors_id': list(set(actors_id)),
+  }
+
+def bulk_add(model, parse, related, related_key, id_key):
+  body = request.get_json()
+  if not isinstance(body, list) or not body or len(body) > MAX_BULK_SIZE:
     abort(400)
-  else:
-    name = body.get('name')
-    age = body.get('age')
-    gender = body.get('gender')
-    movies_id = list(set(body.get('movies_id', [])))
 
-  if name is None or age is None or gender is None:
+  results = [None] * len(body)
+  items = []
+  for i, item in enumerate(body):
+    row = parse(item)
+    if row is None:
+      results[i] = {'success': False, 'error': 400, 'message': 'bad request'}
+    else:
+      items.append((i, row))
+
+  try:
+    existing = get_existing_ids(related, {id for i, row in items for id in row[related_key]})
+  except:
+    abort(422)
+
+  valid = []
+  for i, row in items:
+    missing = sorted(set(row[related_key]) - existing)
+    if missing:
+      # some or all referenced ids do not exist
+      results[i] = {
+          'success': False,
+          'error': 404,
+          'message': 'resource not found',
+          f'missing_{related_key}': missing,
+      }
+    else:
+      valid.append((i, row))
+
+  try:
+    ids = run_write(lambda: model.bulk_insert([row for i, row in valid]))
+  except:
+    # processing error
+    abort(422)
+  for (i, row), id in zip(valid, ids):
+    results[i] = {'success': True, id_key: id}
+
+  return jsonify({
+      'success': True,
+      'results': results,
+      'total_inserted': len(ids),
+  })
+
+@APP.route('/actors/bulk', methods=['POST'])
+@requires_auth('post:actor')
+def add_actors_bulk(payload):
+  #
+  # Endpoint to add many actors at once, requires post:actor permission
+  #
+
+  return bulk_add(Actor, parse_bulk_actor, Movie, 'movies_id', 'actor_id')
+
+@APP.route('/movies/bulk', methods=['POST'])
+@requires_auth('post:movie')
+def add_movies_bulk(payload):
+  #
+  # Endpoint to add many movies at once, requires post:movie permission
+  #
+
+  return bulk_add(Movie, parse_bulk_movie, Actor, 'actors_id', 'movie_id')
+
+#
+# Partial updates. A PATCH body holds any of the fields of the resource,
+# the full list of related ids to set, and ids to add to or remove from the
+# current ones. Only the fields given are validated and written, with one
+# UPDATE, and only the association rows that change
+#
+def parse_str(value):
+  if not isinstance(value, str):
+    raise ValueError(value)
+  return value
+
+def parse_int(value):
+  if not is_int(value):
+    raise ValueError(value)
+  return value
+
+def parse_ids(value):
+  if not is_id_list(value):
+    raise ValueError(value)
+  return set(value)
+
+PATCH_FIELDS = {
+    'actor': {
+        'name': parse_str,
+        'age': parse_int,
+        'gender': Gender,
+    },
+    'movie': {
+        'title': parse_str,
+        'date_release': lambda v: parse_date(parse_str(v)),
+    },
+}
+
+def parse_patch(model, body, related_key):
+  #
+  # Return (values, ids, add, remove) of a PATCH body: the column values
+  # given, the related ids to set (None to keep them), and the ids to add
+  # and remove. None if the body is not valid
+  #
+  if not isinstance(body, dict):
+    return None
+  fields = PATCH_FIELDS[model.__tablename__]
+  keys = (related_key, f'add_{related_key}', f'remove_{related_key}')
+  if not any(k in body for k in list(fields) + list(keys)):
+    return None
+  try:
+    values = {k: parse(body[k]) for k, parse in fields.items() if k in body}
+    ids, add, remove = (parse_ids(body[k]) if k in body else None for k in keys)
+  except ValueError:
+    return None
+  add = add or set()
+  remove = remove or set()
+  if add & remove:
+    return None
+  return values, ids, add, remove
+
+def patch_item(model, item_id, related, related_key, parent_column, related_column):
+  parsed = parse_patch(model, request.get_json(silent=True), related_key)
+  if parsed is None:
     abort(400)
-  else:
-    # determine all the movies exist
-    movies = check_movies_exist(movies_id)
-    #print(movies)
-    if movies is not None or movies_id == []:
-      #print(f'{name} {age} {gender} {movies}')
-      try:
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-      except:
-        abort(422)
-      if actor:
-        try:
-          actor.name = name
-          actor.age = age
-          actor.gender = Gender(gender)
-          actor.movies = movies
-          actor.update()
-        except:
-          abort(422)
-      else:
-        #print('1')
-        # The actor that going to be modified does not exist
-        abort(404)
+  values, ids, add, remove = parsed
+  resource = f'{model.__tablename__}s'
+  # a movie can not be left without actors
+  allow_empty = model is Actor
+
+  try:
+    missing = get_missing_ids(related, (ids or set()) | add)
+  except:
+    abort(422)
+  if missing:
+    # Some or all related ids do not exist
+    abort_missing(related_key, missing)
+
+  def write():
+    if values:
+      table = model.__table__
+      found = db.session.execute(
+          table.update().where(table.c.id == item_id).values(**values)).rowcount == 1
+      if found:
+        mark_changed(db.session, resource, {item_id})
     else:
-      #print('2')
-      # Some or all movies_id do not exist
-      abort(404)
+      found = bool(get_existing_ids(model, [item_id]))
+    if found:
+      update_association_ids(db.session, parent_column, related_column, item_id,
+                             ids, add, remove, allow_empty)
+      commit_write(db.session)
+    return found
+
+  try:
+    found = run_write(write)
+  except ValueError:
+    # The movie would be left without actors, nothing is written
+    abort(400)
+  except:
+    abort(422)
+  if not found:
+    # The actor or movie going to be modified does not exist
+    abort(404)
+
+@APP.route('/actors/<int:actor_id>', methods=['PATCH'])
+@requires_auth('patch:actor')
+def update_actor(payload, actor_id):
+  #
+  # Endpoint to update actor. Any of name, age, gender and movies_id can be given,
+  # movies can also be added by add_movies_id and removed by remove_movies_id.
+  # Actor can only be updated if all the movies given exist
+  #
 
+  patch_item(Actor, actor_id, Movie, 'movies_id',
+             association_table.c.actor_id, association_table.c.movie_id)
   return jsonify({
         'success': True,
-        'actor_id': actor.id,
+        'actor_id': actor_id,
   })
 
 @APP.route('/movies/<int:movie_id>', methods=['PATCH'])
 @requires_auth('patch:movie')
 def update_movie(payload, movie_id):
   #
-  # Endpoint to update movie. Must provide title, date_release and actors_id,
-  # endpoint will check the existence of the actors_id provided, movie can be
-  # updated if all actors_id exist
+  # Endpoint to update movie. Any of title, date_release and actors_id can be given,
+  # actors can also be added by add_actors_id and removed by remove_actors_id.
+  # Movie can only be updated if all the actors given exist and it keeps at least one
   #
-  body = request.get_json()
-
-  if not body:
-    abort(400)
-  else:
-    title = body.get('title')
-    date_release = body.get('date_release')
-    actors_id = list(set(body.get('actors_id', []))) 
-
-  if title is None or date_release is None or actors_id == []:
-    abort(400)
-  else:
-    # determine all the actors exist
-    actors = check_actors_exist(actors_id)
-    if actors:
-      try:
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-      except:
-        abort(422)
-      if movie:
-        try:
-          movie.title = title
-          movie.date_release = datetime.datetime.strptime(date_release, '%Y%m%d').date()
-          movie.actors = actors
-          movie.update()
-        except:
-          abort(422)
-      else:
-        #print('1')
-        # The movie going to be modified does not exist
-        abort(404)
-    else:
-      #print('2')
-      # Some or all actors_id do not exist
-      abort(404)
 
+  patch_item(Movie, movie_id, Actor, 'actors_id',
+             association_table.c.movie_id, association_table.c.actor_id)
   return jsonify({
         'success': True,
-        'movie_id': movie.id,
+        'movie_id': movie_id,
   })
 
 #
@@ -0,0 +1,374 @@
+import os
+import re
+import asyncio
+import logging
+from urllib.parse import parse_qsl
+
+import asyncpg
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, parse_date, http_date
+
+import auth
+from auth import AuthError, parse_auth_header, get_token_kid, decode_payload, \
+    check_permissions
+from app import APP, FILTER_ARGS, encode_cursor, get_page_args, get_total_arg, \
+    make_etag, make_last_modified, is_not_modified
+from models import GENDER_VALUES, DB_POOL_MODE, DB_STATEMENT_TIMEOUT, READ_MODEL
+from serialize import dumps, dumps_with_list
+
+#
+# ASGI entry point, run with an async worker instead of app:APP
+#
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+#
+# The read endpoints (GET /actors, /movies, /actors/<id>, /movies/<id>) are
+# served on the event loop with asyncpg and an async JWKS fetch, so one
+# process keeps many requests in flight while they wait on Postgres or
+# the identity provider. Everything else (writes, streams, filtered lists,
+# the health check) is handed to the Flask APP in a thread, with the same
+# responses.
+#
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', '2'))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', '20'))
+
+FLASK_APP = WsgiToAsgi(APP)
+
+pool = None
+
+#
+# Same JSON and messages as the error handlers of app.py
+#
+ERROR_MESSAGES = {
+  400: 'bad request',
+  404: 'resource not found',
+  405: 'method not allow',
+  422: 'unprocessable',
+  500: 'internal server error',
+}
+
+def dump_json(data):
+  # byte for byte what jsonify returns
+  return dumps(data) + b'\n'
+
+def error_body(status, message):
+  return dump_json({
+      'success': False,
+      'error': status,
+      'message': message,
+  })
+
+class Request:
+  def __init__(self, scope):
+    self.method = scope['method']
+    self.path = scope['path']
+    self.args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'),
+                                    keep_blank_values=True))
+    self.headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+                    for k, v in scope['headers']}
+
+'''
+AsyncJWKS
+    async refresh of auth.JWKS_CACHE. The keys, the ttl and the rate limit
+    are kept by the JWKS cache itself, only the HTTP fetch is done here, by
+    a single task that concurrent requests missing at the same time await.
+    A file:// JWKS_URL is read by the sync cache in a thread.
+'''
+class AsyncJWKS:
+  def __init__(self):
+    self._inflight = None
+
+  async def get_key(self, kid):
+    cache = auth.JWKS_CACHE
+    if cache.needs_refresh(kid):
+      await self.refresh(cache)
+    return cache.peek(kid)
+
+  async def get_version(self):
+    cache = auth.JWKS_CACHE
+    if cache.needs_refresh():
+      await self.refresh(cache)
+    return cache.version
+
+  async def refresh(self, cache):
+    if not cache.url.startswith(('http://', 'https://')):
+      await asyncio.get_event_loop().run_in_executor(None, cache.refresh)
+      return
+    if self._inflight is None:
+      if not cache.can_fetch():
+        cache.check_available()
+        return
+      self._inflight = asyncio.ensure_future(self._fetch(cache))
+      self._inflight.add_done_callback(self._done)
+    await asyncio.shield(self._inflight)
+    cache.check_available()
+
+  def _done(self, task):
+    if self._inflight is task:
+      self._inflight = None
+
+  async def _fetch(self, cache):
+    now = cache.begin_fetch()
+    try:
+      async with httpx.AsyncClient(timeout=cache.timeout) as client:
+        res = await client.get(cache.url)
+        res.raise_for_status()
+        jwks = res.json()
+        cache_control = res.headers.get('Cache-Control')
+    except Exception as err:
+      cache.fetch_failed(now, err)
+      return
+    cache.load(jwks, cache_control, now)
+
+JWKS = AsyncJWKS()
+
+async def requires_auth(request, permission):
+  #
+  # Same checks as auth.requires_auth, sharing its verified token cache
+  #
+  token = parse_auth_header(request.headers.get('authorization'))
+  version = await JWKS.get_version()
+  payload = auth.TOKEN_CACHE.get(token, version)
+  if payload is None:
+    payload = decode_payload(token, await JWKS.get_key(get_token_kid(token)))
+    auth.TOKEN_CACHE.put(token, payload, version)
+  check_permissions(permission, payload)
+  return payload
+
+#
+# Queries, the same rows and ids as Actor.format_all and Movie.format_all
+#
+ACTOR_COLUMNS = 'id, name, age, gender::text AS gender'
+MOVIE_COLUMNS = "id, title, to_char(date_release, 'YYYYMMDD') AS date_release"
+ASSOCIATION_QUERY = '''
+  SELECT {key}, array_agg({value} ORDER BY {value}) FROM association
+  WHERE {key} = ANY($1::int[]) AND {value} IS NOT NULL GROUP BY {key}'''
+
+def format_actor(row, movies_id):
+  return {
+      'id': row['id'],
+      'name': row['name'],
+      'age': row['age'],
+      'gender': GENDER_VALUES[row['gender']],
+      'movies_id': movies_id.get(row['id'], []),
+  }
+
+def format_movie(row, actors_id):
+  return {
+      'id': row['id'],
+      'title': row['title'],
+      'date_release': row['date_release'],
+      'actors_id': actors_id.get(row['id'], []),
+  }
+
+class Resource:
+  def __init__(self, name, item_key, table, columns, association_key,
+               association_value, format, permission):
+    self.name = name
+    self.item_key = item_key
+    self.table = table
+    self.list_query = f'''
+      SELECT {columns} FROM {table}
+      WHERE ($1::int IS NULL OR id > $1) ORDER BY id LIMIT $2'''
+    self.item_query = f'SELECT {columns} FROM {table} WHERE id = $1'
+    self.doc_query = f'''
+      SELECT id, doc FROM {table}_doc
+      WHERE ($1::int IS NULL OR id > $1) ORDER BY id LIMIT $2'''
+    self.association_query = ASSOCIATION_QUERY.format(key=association_key,
+                                                      value=association_value)
+    self.format = format
+    self.permission = permission
+
+ACTORS = Resource('actors', 'actor', 'actor', ACTOR_COLUMNS,
+                  'actor_id', 'movie_id', format_actor, 'get:actors')
+MOVIES = Resource('movies', 'movie', 'movie', MOVIE_COLUMNS,
+                  'movie_id', 'actor_id', format_movie, 'get:movies')
+
+async def format_all(conn, resource, rows):
+  if not rows:
+    return []
+  ids = await conn.fetch(resource.association_query, [r['id'] for r in rows])
+  ids = {r[0]: list(r[1]) for r in ids}
+  return [resource.format(r, ids) for r in rows]
+
+async def count_rows(conn, resource, estimate):
+  if estimate:
+    count = await conn.fetchval(
+        'SELECT reltuples::bigint FROM pg_class WHERE oid = CAST($1 AS regclass)',
+        resource.table)
+    if count is not None and count >= 0:
+      return count
+  return await conn.fetchval(f'SELECT count(id) FROM {resource.table}')
+
+async def list_body(conn, request, resource):
+  limit, after_id = get_page_args(request.args)
+  total = get_total_arg(request.args)
+  # the read model holds the items serialized, as list_response in app.py
+  query = resource.doc_query if READ_MODEL else resource.list_query
+  rows = await conn.fetch(query, after_id, None if limit is None else limit + 1)
+  next_cursor = None
+  if limit is not None and len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['id'])
+
+  ans = {
+      'success': True,
+  }
+  if limit is None:
+    ans[f'total_{resource.name}'] = len(rows)
+  else:
+    ans['next_cursor'] = next_cursor
+    if total is not None:
+      ans[f'total_{resource.name}'] = await count_rows(conn, resource, total == 'estimate')
+  if READ_MODEL:
+    docs = [row['doc'].encode() for row in rows]
+    return 200, dumps_with_list(resource.name, docs, ans) + b'\n'
+  ans[resource.name] = await format_all(conn, resource, rows)
+  return 200, dump_json(ans)
+
+async def item_body(conn, request, resource, item_id):
+  rows = await conn.fetch(resource.item_query, item_id)
+  items = await format_all(conn, resource, rows)
+  if not items:
+    return 404, error_body(404, ERROR_MESSAGES[404])
+  return 200, dump_json({
+      resource.item_key: items[0],
+      'success': True,
+  })
+
+async def conditional(conn, request, resource, build):
+  #
+  # Conditional GET on the resource version, as conditional_response in app.py
+  #
+  row = await conn.fetchrow(
+      'SELECT version, updated_at FROM resource_version WHERE resource = $1',
+      resource.name)
+  version, updated_at = (row['version'], row['updated_at']) if row else (0, None)
+  etag = make_etag(resource.name, version, request.path, request.args)
+  last_modified = make_last_modified(updated_at)
+  not_modified = is_not_modified(etag, last_modified,
+                                 parse_etags(request.headers.get('if-none-match')),
+                                 parse_date(request.headers.get('if-modified-since')))
+
+  if not_modified:
+    status, body = 304, b''
+  else:
+    status, body = await build()
+    if status != 200:
+      return status, body, []
+  headers = [('ETag', f'"{etag}"')]
+  if last_modified is not None:
+    headers.append(('Last-Modified', http_date(last_modified)))
+  return status, body, headers
+
+async def get_list(request, resource):
+  await requires_auth(request, resource.permission)
+  async with pool.acquire() as conn:
+    return await conditional(conn, request, resource,
+                             lambda: list_body(conn, request, resource))
+
+async def get_item(request, resource, item_id):
+  await requires_auth(request, resource.permission)
+  async with pool.acquire() as conn:
+    return await conditional(conn, request, resource,
+                             lambda: item_body(conn, request, resource, item_id))
+
+ROUTES = [
+  (re.compile(r'/actors'), lambda request: get_list(request, ACTORS)),
+  (re.compile(r'/movies'), lambda request: get_list(request, MOVIES)),
+  (re.compile(r'/actors/(\d+)'),
+   lambda request, item_id: get_item(request, ACTORS, int(item_id))),
+  (re.compile(r'/movies/(\d+)'),
+   lambda request, item_id: get_item(request, MOVIES, int(item_id))),
+]
+
+def match_route(request):
+  #
+  # Native handler of the request, None to hand it to Flask
+  #
+  if request.method != 'GET' or 'stream' in request.args \
+      or not FILTER_ARGS.isdisjoint(request.args):
+    return None, None
+  for pattern, handler in ROUTES:
+    m = pattern.fullmatch(request.path)
+    if m:
+      return handler, m.groups()
+  return None, None
+
+async def handle(request, handler, args):
+  try:
+    return await handler(request, *args)
+  except AuthError as error:
+    return error.status_code, error_body(error.status_code, error.error['description']), []
+  except HTTPException as error:
+    code = error.code if error.code in ERROR_MESSAGES else 500
+    return code, error_body(code, ERROR_MESSAGES[code]), []
+  except (asyncpg.PostgresError, LookupError):
+    # processing error, as the abort(422) around the queries in app.py
+    logging.exception('async read failed')
+    return 422, error_body(422, ERROR_MESSAGES[422]), []
+  except Exception:
+    logging.exception('async request failed')
+    return 500, error_body(500, ERROR_MESSAGES[500]), []
+
+def pool_options():
+  #
+  # Behind an external pooler the server connection changes between
+  # transactions, so no prepared statements are cached on it and the
+  # statement timeout is enforced by the client instead of a startup option
+  #
+  if DB_POOL_MODE == 'external':
+    return {
+        'statement_cache_size': 0,
+        'command_timeout': DB_STATEMENT_TIMEOUT / 1000 or None,
+    }
+  if DB_STATEMENT_TIMEOUT:
+    return {'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}}
+  return {}
+
+async def lifespan(receive, send):
+  global pool
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      try:
+        pool = await asyncpg.create_pool(os.environ['DATABASE_URL'],
+                                         min_size=ASYNC_DB_POOL_MIN_SIZE,
+                                         max_size=ASYNC_DB_POOL_MAX_SIZE,
+                                         **pool_options())
+      except Exception as e:
+        await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+        return
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      if pool is not None:
+        await pool.close()
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+async def app(scope, receive, send):
+  if scope['type'] == 'lifespan':
+    await lifespan(receive, send)
+    return
+
+  request = Request(scope) if scope['type'] == 'http' else None
+  handler, args = match_route(request) if request else (None, None)
+  if handler is None:
+    await FLASK_APP(scope, receive, send)
+    return
+
+  status, body, headers = await handle(request, handler, args)
+  if status != 304:
+    headers = [('Content-Type', 'application/json'),
+               ('Content-Length', str(len(body)))] + headers
+  if 'origin' in request.headers:
+    # as flask_cors with its defaults
+    headers.append(('Access-Control-Allow-Origin', '*'))
+  await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+  })
+  await send({'type': 'http.response.body', 'body': body})
@@ -1,14 +1,35 @@
+import os
+import re
 import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from metrics import timed
+
 
 AUTH0_DOMAIN = 'dev20.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'ndfs_capstone'
 
+#
+# JWKS location and caching, the url can be pointed to a local stub server
+# or a file:// path for testing
+#
+JWKS_URL = os.getenv('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', '600'))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', '30'))
+
+#
+# Number of verified tokens to remember, 0 disables the cache
+#
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '1024'))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -20,6 +41,215 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS cache
+
+'''
+JWKSCache
+    keeps the RSA keys of the JWKS endpoint per kid in process memory
+
+    the key set is fetched again once the Cache-Control max-age (or the default
+    ttl if the response has none) is over. An unknown kid triggers a refresh,
+    but not more often than once every min_refresh_interval seconds so a
+    bogus kid can not be used to hammer the identity provider. Concurrent
+    threads missing at the same time wait for the one fetch in flight.
+    While no key could be fetched yet, every refresh, including the ones
+    waiting for the fetch and the rate limited ones, fails with a 503.
+
+    version is bumped every time the fetched key set differs from the one
+    before, so anything derived from the keys can tell it is stale.
+'''
+class JWKSCache:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=10):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetches = 0
+        self.version = 0
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = None
+        self._fetch_error = None
+        self._lock = threading.Lock()
+        self._inflight = None
+
+    def get_key(self, kid):
+        if self.needs_refresh(kid):
+            self.refresh()
+        return self._keys.get(kid)
+
+    def get_version(self):
+        if self.needs_refresh():
+            self.refresh()
+        return self.version
+
+    def peek(self, kid):
+        return self._keys.get(kid)
+
+    def needs_refresh(self, kid=None):
+        now = time.monotonic()
+        if now >= self._expires_at:
+            return True
+        # key rotated at the identity provider before our ttl is over
+        return kid is not None and kid not in self._keys and self._can_refresh(now)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._expires_at = 0
+            self._last_fetch = None
+
+    def refresh(self):
+        #
+        # Single flight, the first thread fetches and the others wait for it
+        #
+        with self._lock:
+            event = self._inflight
+            leader = event is None
+            if leader:
+                event = self._inflight = threading.Event()
+        if not leader:
+            event.wait(self.timeout)
+            self.check_available()
+            return
+
+        try:
+            # another thread may have refreshed while we were getting the lock
+            if self.can_fetch():
+                self._fetch()
+        finally:
+            with self._lock:
+                self._inflight = None
+            event.set()
+        self.check_available()
+
+    def check_available(self):
+        # without any key every token would be rejected as a client error
+        if not self._keys:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'unable to fetch the signing keys.'
+            }, 503) from self._fetch_error
+
+    def _can_refresh(self, now):
+        return self._last_fetch is None or \
+            now - self._last_fetch >= self.min_refresh_interval
+
+    def can_fetch(self):
+        return self._can_refresh(time.monotonic())
+
+    def _fetch(self):
+        now = self.begin_fetch()
+        try:
+            with urlopen(self.url, timeout=self.timeout) as res:
+                jwks = json.loads(res.read())
+                cache_control = res.headers.get('Cache-Control')
+        except Exception as err:
+            self.fetch_failed(now, err)
+            return
+        self.load(jwks, cache_control, now)
+
+    #
+    # The fetch is split in steps so that a caller doing its own I/O (the
+    # async entry point) shares the bookkeeping and parsing
+    #
+    def begin_fetch(self):
+        now = time.monotonic()
+        self._last_fetch = now
+        self.fetches += 1
+        return now
+
+    def fetch_failed(self, now, err):
+        # identity provider unreachable, keep serving the keys we have
+        self._fetch_error = err
+        self.check_available()
+        self._expires_at = now + self.min_refresh_interval
+
+    def load(self, jwks, cache_control, now):
+        ttl = self._max_age(cache_control)
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        if keys != self._keys:
+            self.version += 1
+        self._keys = keys
+        self._fetch_error = None
+        self._expires_at = now + ttl
+
+    def _max_age(self, cache_control):
+        if not cache_control:
+            return self.ttl
+        if 'no-store' in cache_control or 'no-cache' in cache_control:
+            return 0
+        m = re.search(r'max-age=(\d+)', cache_control)
+        if m:
+            return int(m.group(1))
+        return self.ttl
+
+JWKS_CACHE = JWKSCache(JWKS_URL, JWKS_CACHE_TTL, JWKS_MIN_REFRESH_INTERVAL)
+
+
+## Verified token cache
+
+'''
+VerifiedTokenCache
+    bounded LRU of already verified payloads keyed by the sha256 of the token
+
+    an entry is dropped once the token passes its exp claim or the JWKS key
+    set it was verified against has changed. Tokens without exp are never
+    cached.
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token, version):
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, exp, entry_version = entry
+                if entry_version == version and time.time() < exp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload, version):
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[key] = (payload, exp, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+TOKEN_CACHE = VerifiedTokenCache(TOKEN_CACHE_SIZE)
+
+
 ## Auth Header
 
 '''
@@ -32,7 +262,11 @@ class AuthError(Exception):
 '''
 def get_token_auth_header():
    
-   auth = request.headers.get('Authorization', None)
+   return parse_auth_header(request.headers.get('Authorization', None))
+   #raise Exception('Not Implemented')
+
+def parse_auth_header(auth):
+
    #print(auth)
    if not auth:
        raise AuthError({
@@ -57,7 +291,6 @@ def get_token_auth_header():
 		}, 401)
 
    return parts[1]
-   #raise Exception('Not Implemented')
 
 '''
 @TODO implement check_permissions(permission, payload) method
@@ -102,8 +335,9 @@ def check_permissions(permission, payload):
 '''
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return decode_payload(token, JWKS_CACHE.get_key(get_token_kid(token)))
+
+def get_token_kid(token):
     try:
         unverified_header = jwt.get_unverified_header(token)
     except:
@@ -112,23 +346,15 @@ def verify_decode_jwt(token):
             'description': 'Error decoding token headers.'
         }, 401)
 
-    rsa_key = {}
-
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    return unverified_header['kid']
+
+def decode_payload(token, rsa_key):
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -162,6 +388,23 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+'''
+verify_decode_jwt_cached(token)
+    same as verify_decode_jwt but returns the payload from TOKEN_CACHE when the
+    token was already verified against the current JWKS key set
+'''
+def verify_decode_jwt_cached(token):
+    with timed('auth_jwks'):
+        version = JWKS_CACHE.get_version()
+    payload = TOKEN_CACHE.get(token, version)
+    if payload is None:
+        with timed('auth_jwks'):
+            rsa_key = JWKS_CACHE.get_key(get_token_kid(token))
+        with timed('auth_verify'):
+            payload = decode_payload(token, rsa_key)
+        TOKEN_CACHE.put(token, payload, version)
+    return payload
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
@@ -176,9 +419,11 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth_header'):
+                token = get_token_auth_header()
+            payload = verify_decode_jwt_cached(token)
+            with timed('auth_permission'):
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
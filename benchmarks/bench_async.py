@@ -0,0 +1,92 @@
+#
+# Load test of the sync entry point (gunicorn app:APP, sync workers) against
+# the async one (gunicorn asgi:app with uvicorn workers) on the same local
+# Postgres database, with self-signed tokens. Both servers are started
+# here, one after the other, with the same number of worker processes.
+#
+# Needs an empty scratch Postgres database, its tables are dropped, and
+# the packages of requirements-async.txt:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.bench_async [rows] [concurrency] [seconds] [workers]
+#
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+
+from benchmarks.tokens import auth_header
+from benchmarks import loadgen
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+from app import APP
+from models import db, ResourceVersion
+
+PORT = 8765
+
+SERVERS = {
+    'sync': ['gunicorn', 'app:APP'],
+    'async': ['gunicorn', 'asgi:app', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+PATHS = ['/actors?limit=100', '/movies?limit=100', '/actors/1']
+
+def seed(rows):
+    client = APP.test_client()
+    headers = auth_header()
+    with APP.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([ResourceVersion(resource='actors', version=0),
+                            ResourceVersion(resource='movies', version=0)])
+        db.session.commit()
+        db.session.remove()
+    actors = [{'name': f'Actor {i}', 'age': 30, 'gender': 'F'} for i in range(rows)]
+    assert client.post('/actors/bulk', headers=headers, json=actors).status_code == 200
+    movies = [{'title': f'Movie {i}', 'date_release': '20200401', 'actors_id': [i % rows + 1]}
+              for i in range(rows)]
+    assert client.post('/movies/bulk', headers=headers, json=movies).status_code == 200
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server did not start on port {port}')
+
+def bench_server(command, workers, concurrency, seconds):
+    # the response cache would hide the database round trips being compared
+    env = dict(os.environ, RESPONSE_CACHE_BACKEND='off', ITEM_CACHE_SIZE='0')
+    server = subprocess.Popen(command + ['-w', str(workers), '-b', f'127.0.0.1:{PORT}'],
+                              env=env, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(PORT)
+        headers = auth_header()
+        return {path: loadgen.run(f'http://127.0.0.1:{PORT}{path}', headers,
+                                  concurrency, seconds)
+                for path in PATHS}
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 2
+    seed(rows)
+    results = {
+        'rows': rows,
+        'concurrency': concurrency,
+        'workers': workers,
+    }
+    for name, command in SERVERS.items():
+        results[name] = bench_server(command, workers, concurrency, seconds)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
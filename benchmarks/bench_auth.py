@@ -0,0 +1,38 @@
+#
+# Micro-benchmark of token verification with and without the verified token
+# cache. Signs its own token against a JWKS served from a file, no network
+# or database needed.
+#
+# Run from the repository root:
+#
+#   python -m benchmarks.bench_auth [iterations]
+#
+import sys
+import json
+import time
+
+from benchmarks.tokens import make_token
+import auth
+from auth import VerifiedTokenCache, verify_decode_jwt, verify_decode_jwt_cached
+
+def run(fn, token, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(token)
+    return iterations / (time.perf_counter() - start)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    token = make_token(['get:actors'])
+    auth.TOKEN_CACHE = VerifiedTokenCache(1024)
+    uncached = run(verify_decode_jwt, token, iterations)
+    cached = run(verify_decode_jwt_cached, token, iterations)
+    print(json.dumps({
+        'iterations': iterations,
+        'uncached_verifications_per_sec': round(uncached),
+        'cached_verifications_per_sec': round(cached),
+        'speedup': round(cached / uncached, 1),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
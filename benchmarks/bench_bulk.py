@@ -0,0 +1,64 @@
+#
+# Insert throughput of POST /actors/bulk and POST /movies/bulk against the
+# per-row POST /actors and POST /movies endpoints, through the Flask test
+# client with self-signed tokens.
+#
+# Needs an empty scratch Postgres database, its tables are dropped:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.bench_bulk [rows]
+#
+import os
+import sys
+import json
+import time
+
+from benchmarks.tokens import auth_header
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+from app import APP
+from models import db
+
+def rows_per_sec(n, fn):
+    start = time.perf_counter()
+    fn()
+    return round(n / (time.perf_counter() - start))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    client = APP.test_client()
+    headers = auth_header()
+    actors = [{'name': f'Actor {i}', 'age': 30, 'gender': 'F'} for i in range(n)]
+
+    with APP.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.remove()
+
+    def per_row_actors():
+        for a in actors:
+            assert client.post('/actors', headers=headers, json=a).status_code == 200
+
+    def bulk_actors():
+        assert client.post('/actors/bulk', headers=headers, json=actors).status_code == 200
+
+    results = {'rows': n}
+    results['per_row_actors_per_sec'] = rows_per_sec(n, per_row_actors)
+    results['bulk_actors_per_sec'] = rows_per_sec(n, bulk_actors)
+
+    # every movie is acted by the first actor
+    movies = [{'title': f'Movie {i}', 'date_release': '20200401', 'actors_id': [1]}
+              for i in range(n)]
+
+    def per_row_movies():
+        for m in movies:
+            assert client.post('/movies', headers=headers, json=m).status_code == 200
+
+    def bulk_movies():
+        assert client.post('/movies/bulk', headers=headers, json=movies).status_code == 200
+
+    results['per_row_movies_per_sec'] = rows_per_sec(n, per_row_movies)
+    results['bulk_movies_per_sec'] = rows_per_sec(n, bulk_movies)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
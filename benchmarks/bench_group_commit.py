@@ -0,0 +1,81 @@
+#
+# Write throughput of concurrent POST /actors requests with and without
+# the group commit, through the Flask test client with self-signed tokens.
+# Each thread posts its actors one after the other, the commits are
+# counted on the engine, so commits per second against writes per second
+# shows how many writes each transaction held.
+#
+# Needs an empty scratch Postgres database, its tables are dropped:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.bench_group_commit [threads] [writes per thread]
+#
+import os
+import sys
+import json
+import time
+import threading
+from sqlalchemy import event
+
+from benchmarks.tokens import auth_header
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+from app import APP
+from models import db, ResourceVersion
+import models
+
+def seed():
+    with APP.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([ResourceVersion(resource='actors', version=0),
+                            ResourceVersion(resource='movies', version=0)])
+        db.session.commit()
+        db.session.remove()
+
+def run(threads, writes, group_commit):
+    models.GROUP_COMMIT = group_commit
+    headers = auth_header()
+    commits = []
+    with APP.app_context():
+        engine = db.engine
+    def listener(conn):
+        commits.append(1)
+    event.listen(engine, 'commit', listener)
+
+    def post(t):
+        client = APP.test_client()
+        for i in range(writes):
+            res = client.post('/actors', headers=headers,
+                              json={'name': f'Actor {t} {i}', 'age': 30, 'gender': 'F'})
+            assert res.status_code == 200
+
+    workers = [threading.Thread(target=post, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    event.remove(engine, 'commit', listener)
+    return {
+        'writes_per_sec': round(threads * writes / elapsed),
+        'commits_per_sec': round(len(commits) / elapsed),
+        'writes_per_commit': round(threads * writes / len(commits), 2),
+    }
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    seed()
+    results = {
+        'threads': threads,
+        'writes': threads * writes,
+        'window_ms': models.GROUP_COMMIT_WINDOW * 1000,
+        'max_size': models.GROUP_COMMIT_MAX_SIZE,
+        'commit_per_request': run(threads, writes, False),
+        'group_commit': run(threads, writes, True),
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
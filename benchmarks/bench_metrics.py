@@ -0,0 +1,79 @@
+#
+# Overhead of the request metrics. Times the list and item endpoints through
+# the Flask test client with the metrics hooks on and off, and the cost of a
+# single phase timer and histogram observation.
+#
+# Needs an empty scratch Postgres database, its tables are dropped:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.bench_metrics [requests]
+#
+import os
+import sys
+import json
+import time
+
+from benchmarks.tokens import auth_header
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+os.environ['RESPONSE_CACHE_BACKEND'] = 'off'
+os.environ['ITEM_CACHE_SIZE'] = '0'
+from app import APP
+from models import db, ResourceVersion
+from metrics import METRICS, Histogram, timed
+
+PATHS = ['/actors?limit=100', '/actors/1']
+
+def seed(rows):
+    client = APP.test_client()
+    with APP.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([ResourceVersion(resource='actors', version=0),
+                            ResourceVersion(resource='movies', version=0)])
+        db.session.commit()
+        db.session.remove()
+    actors = [{'name': f'Actor {i}', 'age': 30, 'gender': 'F'} for i in range(rows)]
+    assert client.post('/actors/bulk', headers=auth_header(), json=actors).status_code == 200
+
+def us_per_request(client, path, headers, n):
+    start = time.perf_counter()
+    for i in range(n):
+        assert client.get(path, headers=headers).status_code == 200
+    return (time.perf_counter() - start) / n * 1e6
+
+def ns_per_call(fn, n=100000):
+    start = time.perf_counter()
+    for i in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e9
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    seed(1000)
+    client = APP.test_client()
+    headers = auth_header()
+    results = {'requests': n}
+    for path in PATHS:
+        us_per_request(client, path, headers, n // 10)
+        METRICS.enabled = False
+        off = us_per_request(client, path, headers, n)
+        METRICS.enabled = True
+        on = us_per_request(client, path, headers, n)
+        results[path] = {
+            'off_us_per_request': round(off, 1),
+            'on_us_per_request': round(on, 1),
+            'overhead_us': round(on - off, 1),
+            'overhead_percent': round((on - off) / off * 100, 2),
+        }
+
+    histogram = Histogram('bench', 'bench', ['route'])
+    results['observe_ns'] = round(ns_per_call(lambda: histogram.observe(0.01, '/actors')))
+    with APP.test_request_context('/'):
+        def phase():
+            with timed('bench'):
+                pass
+        results['timed_phase_ns'] = round(ns_per_call(phase))
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#
+# Write latency while the movie table grows. Each size seeds that many
+# movies (one actor each), then times single actor inserts and an actor
+# update that drops a movie, which is what fires the orphan movie cleanup.
+# With the targeted cleanup the latency should stay flat.
+#
+# Needs an empty scratch Postgres database, its tables are dropped:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.bench_orphans [sizes]
+#
+import os
+import sys
+import json
+import time
+import datetime
+from flask import Flask
+
+from models import setup_db, db, Actor, Movie, Gender, association_table
+
+def seed(n):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Actor.__table__.insert(),
+                       [{'name': f'Actor {i}', 'age': 30, 'gender': Gender.male} for i in range(n)])
+    release = datetime.date(2020, 4, 1)
+    db.session.execute(Movie.__table__.insert(),
+                       [{'title': f'Movie {i}', 'date_release': release} for i in range(n)])
+    db.session.execute(association_table.insert(),
+                       [{'movie_id': i + 1, 'actor_id': i + 1} for i in range(n)])
+    db.session.commit()
+
+def mean_ms(fn, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def insert_actor(i):
+    Actor(name=f'New {i}', age=20, gender=Gender('F')).insert()
+
+def drop_movie(i):
+    # actor i+1 leaves its only movie, which becomes an orphan
+    actor = Actor.query.get(i + 1)
+    actor.movies = []
+    actor.update()
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    app = Flask(__name__)
+    setup_db(app, os.environ['BENCH_DATABASE_URL'])
+
+    results = []
+    with app.app_context():
+        for n in sizes:
+            seed(n)
+            results.append({
+                'movies': n,
+                'insert_actor_ms': round(mean_ms(insert_actor, 200), 3),
+                'update_actor_ms': round(mean_ms(drop_movie, 200), 3),
+            })
+            db.session.remove()
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
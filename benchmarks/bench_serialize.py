@@ -0,0 +1,87 @@
+#
+# Rows serialized per second by the list endpoints: ORM instances through
+# format_all and json (as before), row tuples through format_rows and
+# serialize.dumps with orjson if installed, and the same without it.
+# Query and encoding are timed together, then the encoding alone.
+#
+# Needs an empty scratch Postgres database, its tables are dropped:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.bench_serialize [rows] [repeat]
+#
+import os
+import sys
+import json
+import time
+
+from benchmarks.tokens import auth_header
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+from app import APP
+from models import db, Actor, Movie, ResourceVersion
+import serialize
+
+def seed(rows):
+    client = APP.test_client()
+    headers = auth_header()
+    with APP.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([ResourceVersion(resource='actors', version=0),
+                            ResourceVersion(resource='movies', version=0)])
+        db.session.commit()
+        db.session.remove()
+    actors = [{'name': f'Actor {i}', 'age': 30, 'gender': 'F'} for i in range(rows)]
+    assert client.post('/actors/bulk', headers=headers, json=actors).status_code == 200
+    movies = [{'title': f'Movie {i}', 'date_release': '20200401', 'actors_id': [i % rows + 1]}
+              for i in range(rows)]
+    assert client.post('/movies/bulk', headers=headers, json=movies).status_code == 200
+
+def stdlib_dumps(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+def instances(model):
+    return model.format_all(model.query.order_by(model.id).all())
+
+def row_tuples(model):
+    return model.format_rows(db.session.query(*model.columns()).order_by(model.id).all())
+
+def rows_per_sec(rows, repeat, fn):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        db.session.remove()
+        best = elapsed if best is None else min(best, elapsed)
+    return round(rows / best)
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    seed(rows)
+    results = {
+        'rows': rows,
+        'orjson': serialize.orjson is not None,
+    }
+    with APP.app_context():
+        for model, key in ((Actor, 'actors'), (Movie, 'movies')):
+            items = row_tuples(model)
+            assert serialize.dumps(items) == stdlib_dumps(instances(model))
+            fast = rows_per_sec(rows, repeat, lambda: serialize.dumps(row_tuples(model)))
+            serialize.FAST_JSON = False
+            stdlib = rows_per_sec(rows, repeat, lambda: serialize.dumps(row_tuples(model)))
+            encode_stdlib = rows_per_sec(rows, repeat, lambda: serialize.dumps(items))
+            serialize.FAST_JSON = True
+            results[key] = {
+                'format_all_rows_per_sec': rows_per_sec(
+                    rows, repeat, lambda: stdlib_dumps(instances(model))),
+                'format_rows_rows_per_sec': fast,
+                'format_rows_stdlib_rows_per_sec': stdlib,
+                'encode_rows_per_sec': rows_per_sec(
+                    rows, repeat, lambda: serialize.dumps(items)),
+                'encode_stdlib_rows_per_sec': encode_stdlib,
+            }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#
+# Closed loop HTTP load generator. Each of the concurrent clients keeps one
+# keep-alive connection and sends its next request as soon as the previous
+# one is answered, for a fixed duration. Reports throughput and latency
+# percentiles in milliseconds.
+#
+#   python -m benchmarks.loadgen http://127.0.0.1:8080/actors?limit=100 \
+#       [concurrency] [seconds]
+#
+# Requests carry the PRODUCER_JWT of setup.sh, so the server has to accept
+# the Auth0 tokens. bench_async starts its own servers with self-signed ones.
+#
+import os
+import sys
+import json
+import time
+import threading
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 2),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
+
+def run(url, headers=None, concurrency=16, seconds=10, method='GET', body=None,
+        make_request=None):
+    #
+    # Return the summary of the run, a response other than 2xx or 304 is
+    # counted as an error and not in the latencies. make_request, if given,
+    # is called for every request and returns its (method, path, body), for
+    # requests that can not be repeated such as a DELETE
+    #
+    parts = urlsplit(url)
+    target = parts.path + ('?' + parts.query if parts.query else '')
+    if make_request is None:
+        make_request = lambda: (method, target, body)
+    headers = dict(headers or {})
+    json_headers = dict(headers, **{'Content-Type': 'application/json'})
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + seconds
+
+    def client():
+        conn = HTTPConnection(parts.hostname, parts.port, timeout=30)
+        mine = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            req_method, req_path, req_body = make_request()
+            t = time.perf_counter()
+            try:
+                if req_body is None:
+                    conn.request(req_method, req_path, headers=headers)
+                else:
+                    conn.request(req_method, req_path, body=json.dumps(req_body).encode(),
+                                 headers=json_headers)
+                res = conn.getresponse()
+                res.read()
+                ok = 200 <= res.status < 300 or res.status == 304
+            except Exception:
+                conn.close()
+                conn = HTTPConnection(parts.hostname, parts.port, timeout=30)
+                ok = False
+            if ok:
+                mine.append(time.perf_counter() - t)
+            else:
+                failed += 1
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+def main():
+    url = sys.argv[1]
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    headers = {'Authorization': 'bearer ' + os.environ['PRODUCER_JWT']}
+    print(json.dumps(run(url, headers, concurrency, seconds), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+#
+# Benchmark suite of every endpoint of app.py. Seeds a scratch Postgres
+# database with a reproducible data set, serves its own JWKS and signs its
+# own tokens, starts gunicorn on it and drives each route at a fixed
+# concurrency. Reports throughput, p50/p95/p99 latency and SQL queries per
+# request (from /metrics) as JSON.
+#
+# The tables of BENCH_DATABASE_URL are dropped:
+#
+#   BENCH_DATABASE_URL=postgresql://.../capstone_bench \
+#       python -m benchmarks.suite --size medium --output bench.json
+#
+# GET /profiles/<id> is run last, on a server started again with every
+# request profiled, so that the profile it downloads exists.
+#
+# With --baseline, the run is compared to an earlier output and the
+# command fails if a route got slower or sends more queries:
+#
+#   python -m benchmarks.suite --baseline bench.json
+#
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import subprocess
+from urllib.request import urlopen
+
+from benchmarks.tokens import PERMISSIONS, auth_header, serve_jwks
+from benchmarks import loadgen
+from benchmarks.bench_async import wait_for_port
+import sqlalchemy
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+from app import encode_cursor
+from models import db
+
+SIZES = {
+    'small': (1000, 1000),
+    'medium': (100000, 100000),
+    'large': (1000000, 1000000),
+}
+
+PORT = 8766
+
+# rows kept apart from the base data set for the PATCH and DELETE routes
+PATCH_ROWS = 100
+
+'''
+DataSet
+    ids of the seeded rows. The base actors and movies come first, then the
+    ones that are patched, then the ones that are deleted
+'''
+class DataSet:
+    def __init__(self, actors, movies, deletable):
+        self.actors = actors
+        self.movies = movies
+        self.deletable = deletable
+        self.patch_actors = range(actors + 1, actors + PATCH_ROWS + 1)
+        self.patch_movies = range(movies + 1, movies + PATCH_ROWS + 1)
+        self.delete_actors = itertools.count(actors + PATCH_ROWS + 1)
+        self.delete_movies = itertools.count(movies + PATCH_ROWS + 1)
+
+def seed(url, actors, movies, links, deletable):
+    #
+    # Every base movie has at least one actor and each base actor is linked
+    # to `links` pseudo random movies. The patched rows are linked to actor
+    # or movie 1 only, the deleted actors to no movie
+    #
+    engine = sqlalchemy.create_engine(url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        def insert_actors(n, prefix):
+            conn.execute(sqlalchemy.text('''
+                INSERT INTO actor (name, age, gender)
+                SELECT :prefix || i, 20 + i % 50,
+                       (CASE WHEN i % 2 = 0 THEN 'male' ELSE 'female' END)::gender
+                FROM generate_series(1, :n) AS i'''), prefix=prefix, n=n)
+
+        def insert_movies(n, prefix):
+            conn.execute(sqlalchemy.text('''
+                INSERT INTO movie (title, date_release)
+                SELECT :prefix || i, DATE '2000-01-01' + i % 7300
+                FROM generate_series(1, :n) AS i'''), prefix=prefix, n=n)
+
+        insert_actors(actors, 'Actor ')
+        insert_actors(PATCH_ROWS, 'Patched actor ')
+        insert_actors(deletable, 'Deleted actor ')
+        insert_movies(movies, 'Movie ')
+        insert_movies(PATCH_ROWS, 'Patched movie ')
+        insert_movies(deletable, 'Deleted movie ')
+        conn.execute(sqlalchemy.text('''
+            INSERT INTO association (movie_id, actor_id)
+            SELECT m, (m - 1) % :actors + 1 FROM generate_series(1, :movies) AS m
+            UNION
+            SELECT (a::bigint * 7919 + j * 104729) % :movies + 1, a
+            FROM generate_series(1, :actors) AS a, generate_series(1, :links) AS j
+            UNION
+            SELECT 1, a FROM generate_series(:actors + 1, :actors + :patch) AS a
+            UNION
+            SELECT m, 1 FROM generate_series(:movies + 1, :movies + :patch + :deletable) AS m
+            ON CONFLICT DO NOTHING'''),
+            actors=actors, movies=movies, links=links, patch=PATCH_ROWS, deletable=deletable)
+        conn.execute(sqlalchemy.text('''
+            INSERT INTO resource_version (resource, version)
+            VALUES ('actors', 0), ('movies', 0)'''))
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute('ANALYZE')
+    engine.dispose()
+
+def scenarios(data):
+    #
+    # name -> (route rule, method, request factory), in the order they run.
+    # Reads come first, so that the writes do not change what they read
+    #
+    def get(path):
+        return lambda: ('GET', path, None)
+
+    def actor():
+        return {'name': 'Bench actor', 'age': 30, 'gender': 'F',
+                'movies_id': [random.randint(1, data.movies)]}
+
+    def movie():
+        return {'title': 'Bench movie', 'date_release': '20200401',
+                'actors_id': [random.randint(1, data.actors)]}
+
+    def ids(n):
+        return ','.join(str(i) for i in random.sample(range(1, n + 1), min(n, 50)))
+
+    return {
+        'health': ('/', 'GET', get('/')),
+        'metrics': ('/metrics', 'GET', get('/metrics')),
+        'list_actors_page': ('/actors', 'GET', get('/actors?limit=100')),
+        'list_movies_page': ('/movies', 'GET', get('/movies?limit=100')),
+        'list_actors_deep_page': ('/actors', 'GET', lambda: (
+            'GET', f'/actors?limit=100&cursor={deep_cursor(data)}', None)),
+        'list_actors_total': ('/actors', 'GET', get('/actors?limit=100&total=estimate')),
+        'list_actors_by_age': ('/actors', 'GET', get(
+            '/actors?limit=100&age_min=30&age_max=39&gender=F')),
+        'list_actors_by_name_prefix': ('/actors', 'GET', lambda: (
+            'GET', f'/actors?limit=100&name_prefix=Actor%20{random.randint(1, 999)}', None)),
+        'list_actors_by_name_contains': ('/actors', 'GET', lambda: (
+            'GET', f'/actors?limit=100&name_contains=tor%20{random.randint(1, 999)}', None)),
+        'list_movies_by_date': ('/movies', 'GET', get(
+            '/movies?limit=100&date_release_from=20050101&date_release_to=20051231')),
+        'list_movies_by_title_prefix': ('/movies', 'GET', lambda: (
+            'GET', f'/movies?limit=100&title_prefix=Movie%20{random.randint(1, 999)}', None)),
+        'list_movies_by_title_contains': ('/movies', 'GET', lambda: (
+            'GET', f'/movies?limit=100&title_contains=ie%20{random.randint(1, 999)}', None)),
+        'get_actor': ('/actors/<int:actor_id>', 'GET', lambda: (
+            'GET', f'/actors/{random.randint(1, data.actors)}', None)),
+        'get_movie': ('/movies/<int:movie_id>', 'GET', lambda: (
+            'GET', f'/movies/{random.randint(1, data.movies)}', None)),
+        'get_actor_movies': ('/actors/<int:actor_id>/movies', 'GET', lambda: (
+            'GET', f'/actors/{random.randint(1, data.actors)}/movies', None)),
+        'get_movie_actors': ('/movies/<int:movie_id>/actors', 'GET', lambda: (
+            'GET', f'/movies/{random.randint(1, data.movies)}/actors', None)),
+        'get_actors_movies': ('/actors/movies', 'GET', lambda: (
+            'GET', f'/actors/movies?ids={ids(data.actors)}', None)),
+        'get_movies_actors': ('/movies/actors', 'GET', lambda: (
+            'GET', f'/movies/actors?ids={ids(data.movies)}', None)),
+        'profiles': ('/profiles', 'GET', get('/profiles')),
+        'post_actor': ('/actors', 'POST', lambda: ('POST', '/actors', actor())),
+        'post_movie': ('/movies', 'POST', lambda: ('POST', '/movies', movie())),
+        'post_actors_bulk': ('/actors/bulk', 'POST', lambda: (
+            'POST', '/actors/bulk', [actor() for i in range(100)])),
+        'post_movies_bulk': ('/movies/bulk', 'POST', lambda: (
+            'POST', '/movies/bulk', [movie() for i in range(100)])),
+        'patch_actor': ('/actors/<int:actor_id>', 'PATCH', lambda: (
+            'PATCH', f'/actors/{random.choice(data.patch_actors)}',
+            {'name': 'Patched', 'age': 40, 'gender': 'M', 'movies_id': [1]})),
+        'patch_movie': ('/movies/<int:movie_id>', 'PATCH', lambda: (
+            'PATCH', f'/movies/{random.choice(data.patch_movies)}',
+            {'title': 'Patched', 'date_release': '20200402', 'actors_id': [1]})),
+        'delete_actor': ('/actors/<int:actor_id>', 'DELETE', lambda: (
+            'DELETE', f'/actors/{next(data.delete_actors)}', None)),
+        'delete_movie': ('/movies/<int:movie_id>', 'DELETE', lambda: (
+            'DELETE', f'/movies/{next(data.delete_movies)}', None)),
+    }
+
+def profile_scenarios():
+    #
+    # Run on the profiling server, where the first request of each worker
+    # kept profile 1
+    #
+    return {
+        'get_profile': ('/profiles/<int:profile_id>', 'GET', lambda: (
+            'GET', '/profiles/1', None)),
+        'get_profile_pstats': ('/profiles/<int:profile_id>', 'GET', lambda: (
+            'GET', '/profiles/1?format=pstats', None)),
+    }
+
+def deep_cursor(data):
+    return encode_cursor(random.randint(1, max(data.actors - 100, 1)))
+
+def scrape_queries(base_url):
+    #
+    # (route, method) -> [sum, count] of capstone_sql_queries_per_request
+    #
+    text = urlopen(base_url + '/metrics', timeout=30).read().decode()
+    totals = {}
+    for line in text.splitlines():
+        for suffix, i in (('_sum{', 0), ('_count{', 1)):
+            prefix = 'capstone_sql_queries_per_request' + suffix
+            if line.startswith(prefix):
+                labels, value = line[len(prefix):].rsplit('} ', 1)
+                labels = dict(kv.split('=', 1) for kv in labels.split('",'))
+                key = (labels['route'].strip('"'), labels['method'].strip('"'))
+                totals.setdefault(key, [0.0, 0])[i] = float(value)
+    return totals
+
+def queries_per_request(before, after, key):
+    s0, c0 = before.get(key, [0.0, 0])
+    s1, c1 = after.get(key, [0.0, 0])
+    return round((s1 - s0) / (c1 - c0), 2) if c1 > c0 else None
+
+def compare(results, baseline, tolerance):
+    #
+    # A route regressed if its p95 grew or its throughput dropped by more
+    # than the tolerance, or if it sends more queries per request
+    #
+    regressions = []
+    for name, now in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or not now['requests'] or not before['requests']:
+            continue
+        if now['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {before["p95_ms"]} -> {now["p95_ms"]} ms')
+        if now['requests_per_sec'] < before['requests_per_sec'] * (1 - tolerance):
+            regressions.append(f'{name}: {before["requests_per_sec"]} -> '
+                               f'{now["requests_per_sec"]} requests/s')
+        if before.get('queries_per_request') is not None and \
+                now.get('queries_per_request') is not None and \
+                now['queries_per_request'] > before['queries_per_request']:
+            regressions.append(f'{name}: {before["queries_per_request"]} -> '
+                               f'{now["queries_per_request"]} queries/request')
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark every endpoint of app.py')
+    parser.add_argument('--size', choices=SIZES, default='small')
+    parser.add_argument('--actors', type=int, help='base actors, overrides --size')
+    parser.add_argument('--movies', type=int, help='base movies, overrides --size')
+    parser.add_argument('--links', type=int, default=3, help='movies linked to each actor')
+    parser.add_argument('--deletable', type=int, default=50000,
+                        help='rows seeded for the DELETE routes')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='gunicorn workers, queries per request are only '
+                             'reported for 1')
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn off the response and item caches')
+    parser.add_argument('--only', nargs='*', help='scenarios to run')
+    parser.add_argument('--skip-seed', action='store_true',
+                        help='reuse the data of the previous run with the same sizes')
+    parser.add_argument('--output', help='write the results to this file too')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args()
+
+def start_server(env, args):
+    server = subprocess.Popen(
+        ['gunicorn', 'app:APP', '-w', str(args.workers), '--threads', str(args.threads),
+         '-b', f'127.0.0.1:{PORT}'], env=env, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(PORT)
+    except Exception:
+        server.terminate()
+        raise
+    return server
+
+def run_scenarios(base_url, headers, args, scenarios, results):
+    for name, (route, method, make_request) in scenarios.items():
+        if args.only and name not in args.only:
+            continue
+        if args.warmup:
+            loadgen.run(base_url, headers, args.concurrency, args.warmup,
+                        make_request=make_request)
+        before = scrape_queries(base_url) if args.workers == 1 else None
+        summary = loadgen.run(base_url, headers, args.concurrency, args.seconds,
+                              make_request=make_request)
+        if before is not None:
+            summary['queries_per_request'] = queries_per_request(
+                before, scrape_queries(base_url), (route, method))
+        summary['route'] = f'{method} {route}'
+        results['scenarios'][name] = summary
+
+def main():
+    args = parse_args()
+    url = os.environ['BENCH_DATABASE_URL']
+    actors, movies = SIZES[args.size]
+    actors = args.actors or actors
+    movies = args.movies or movies
+    random.seed(0)
+
+    if not args.skip_seed:
+        start = time.perf_counter()
+        seed(url, actors, movies, args.links, args.deletable)
+        seed_seconds = round(time.perf_counter() - start, 1)
+    else:
+        seed_seconds = None
+
+    serve_jwks()
+    env = dict(os.environ, DATABASE_URL=url, PROFILE_THRESHOLD_MS='0',
+               PROFILE_SAMPLE_RATE='0', METRICS_ENABLED='true')
+    if args.no_cache:
+        env.update(RESPONSE_CACHE_BACKEND='off', ITEM_CACHE_SIZE='0')
+
+    base_url = f'http://127.0.0.1:{PORT}'
+    data = DataSet(actors, movies, args.deletable)
+    headers = auth_header(PERMISSIONS + ['get:profiles'])
+    results = {
+        'revision': git_revision(),
+        'config': {
+            'actors': actors,
+            'movies': movies,
+            'links': args.links,
+            'concurrency': args.concurrency,
+            'seconds': args.seconds,
+            'workers': args.workers,
+            'threads': args.threads,
+            'cache': not args.no_cache,
+            'seed_seconds': seed_seconds,
+        },
+        'scenarios': {},
+    }
+    server = start_server(env, args)
+    try:
+        run_scenarios(base_url, headers, args, scenarios(data), results)
+    finally:
+        server.terminate()
+        server.wait()
+
+    # every request is profiled, a few per worker keep profile 1 in each
+    if not args.only or set(args.only) & set(profile_scenarios()):
+        server = start_server(dict(env, PROFILE_SAMPLE_RATE='1'), args)
+        try:
+            for i in range(args.workers * 10):
+                urlopen(base_url + '/', timeout=30).read()
+            run_scenarios(base_url, headers, args, profile_scenarios(), results)
+        finally:
+            server.terminate()
+            server.wait()
+
+    regressions = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
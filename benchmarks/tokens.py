@@ -0,0 +1,85 @@
+#
+# Self-signed tokens for the benchmarks. Generates an RSA key, writes the
+# matching JWKS to a file and points the auth module at it through
+# JWKS_URL, so no Auth0 tenant is needed. Import this module before app
+# or auth.
+#
+import os
+import json
+import time
+import atexit
+import base64
+import tempfile
+import threading
+from jose import jwt
+from Crypto.PublicKey import RSA
+
+KID = 'bench'
+PERMISSIONS = [
+    'get:actors', 'get:movies',
+    'post:actor', 'post:movie',
+    'patch:actor', 'patch:movie',
+    'delete:actor', 'delete:movie',
+]
+
+def b64_int(i):
+    b = i.to_bytes((i.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(b).rstrip(b'=').decode()
+
+_key = RSA.generate(2048)
+_pem = _key.exportKey('PEM').decode()
+
+_jwks = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+json.dump({'keys': [{
+    'kty': 'RSA',
+    'kid': KID,
+    'use': 'sig',
+    'n': b64_int(_key.n),
+    'e': b64_int(_key.e)
+}]}, _jwks)
+_jwks.close()
+atexit.register(os.unlink, _jwks.name)
+
+JWKS_URL = 'file://' + _jwks.name
+os.environ['JWKS_URL'] = JWKS_URL
+
+def serve_jwks():
+    #
+    # Serve the JWKS over HTTP from a local thread, as the identity provider
+    # would, and point JWKS_URL (of this process and the servers it starts)
+    # at it. Returns the url
+    #
+    global JWKS_URL
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    with open(_jwks.name, 'rb') as f:
+        body = f.read()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Cache-Control', 'public, max-age=600')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    JWKS_URL = f'http://127.0.0.1:{server.server_port}/.well-known/jwks.json'
+    os.environ['JWKS_URL'] = JWKS_URL
+    return JWKS_URL
+
+def make_token(permissions=PERMISSIONS, exp=3600):
+    import auth
+    return jwt.encode({
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'aud': auth.API_AUDIENCE,
+        'exp': int(time.time()) + exp,
+        'permissions': list(permissions)
+    }, _pem, algorithm='RS256', headers={'kid': KID})
+
+def auth_header(permissions=PERMISSIONS):
+    return {'Authorization': 'bearer ' + make_token(permissions)}
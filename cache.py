@@ -0,0 +1,235 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+'''
+Response cache of the read endpoints
+
+    Responses are stored as serialized JSON bytes under a key holding the
+    version of the resource in the database (the resource_version table)
+    they were built from. Writes bump the version in the transaction that
+    commits them, so every worker stops reading the older entries at once,
+    and they simply age out of the backend.
+
+    RESPONSE_CACHE_BACKEND selects the storage:
+        lru    in process memory, each worker fills its own
+        redis  shared by all workers, needs the redis package and
+               RESPONSE_CACHE_REDIS_URL
+        off    no caching
+'''
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'lru')
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_REDIS_URL = os.getenv('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+
+#
+# Single actor and movie cache, per process
+#
+ITEM_CACHE_SIZE = int(os.getenv('ITEM_CACHE_SIZE', '10000'))
+ITEM_CACHE_TTL = float(os.getenv('ITEM_CACHE_TTL', '30'))
+
+'''
+CacheBackend
+    storage interface of the response cache, a shared backend only has to
+    implement these two methods
+'''
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+'''
+LRUBackend
+    in process backend bounded by the total size of the stored values
+'''
+class LRUBackend(CacheBackend):
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                k, v = self._entries.popitem(last=False)
+                self.size -= len(v)
+
+    def __len__(self):
+        return len(self._entries)
+
+'''
+RedisBackend
+    backend shared by all the workers, entries expire after ttl seconds
+'''
+class RedisBackend(CacheBackend):
+    def __init__(self, url=RESPONSE_CACHE_REDIS_URL, ttl=RESPONSE_CACHE_TTL, prefix='capstone:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+'''
+ResponseCache
+    counts hits and misses on top of a backend. Backend errors are logged
+    and treated as misses, the cache must never fail a request
+'''
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.backend is not None
+
+    def key(self, resource, version, variant=''):
+        return f'{resource}:{version}:{variant}'
+
+    def get(self, key):
+        value = None
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            logging.exception('response cache get failed')
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value)
+        except Exception:
+            logging.exception('response cache set failed')
+
+    def stats(self):
+        requests = self.hits + self.misses
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
+        if isinstance(self.backend, LRUBackend):
+            stats['entries'] = len(self.backend)
+            stats['bytes'] = self.backend.size
+        return stats
+
+'''
+ItemCache
+    per process cache of single actors and movies keyed by primary key,
+    bounded in entries and expiring after ttl seconds. Entries are dropped
+    when a committed write changes them; the ttl bounds how long a write
+    made by another worker can go unseen.
+
+    Every invalidation bumps a generation of the resource, and set is
+    ignored if it changed since the value was read from the database, so a
+    read racing a write can not store the old row.
+'''
+class ItemCache:
+    def __init__(self, maxsize=ITEM_CACHE_SIZE, ttl=ITEM_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._invalidated_at = {}
+        self._lock = threading.Lock()
+
+    def generation(self, resource):
+        return self._generations.get(resource, 0)
+
+    def age(self, resource):
+        # seconds since the last invalidation of the resource
+        invalidated_at = self._invalidated_at.get(resource)
+        return float('inf') if invalidated_at is None else time.monotonic() - invalidated_at
+
+    def get(self, resource, id):
+        key = (resource, id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, resource, id, value, generation):
+        if self.maxsize <= 0:
+            return
+        key = (resource, id)
+        with self._lock:
+            if generation != self._generations.get(resource, 0):
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, changed):
+        #
+        # changed is a dict of resource -> set of ids, None for all of them
+        #
+        with self._lock:
+            for resource, ids in changed.items():
+                self._generations[resource] = self._generations.get(resource, 0) + 1
+                self._invalidated_at[resource] = time.monotonic()
+                if ids is None:
+                    for key in [k for k in self._entries if k[0] == resource]:
+                        del self._entries[key]
+                else:
+                    for id in ids:
+                        self._entries.pop((resource, id), None)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'entries': len(self._entries),
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+def create_backend(name=RESPONSE_CACHE_BACKEND):
+    if name == 'off':
+        return None
+    if name == 'redis':
+        return RedisBackend()
+    return LRUBackend()
+
+RESPONSE_CACHE = ResponseCache(create_backend())
+ITEM_CACHE = ItemCache()
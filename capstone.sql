@@ -30,6 +30,20 @@ CREATE EXTENSION IF NOT EXISTS plpgsql WITH SCHEMA pg_catalog;
 COMMENT ON EXTENSION plpgsql IS 'PL/pgSQL procedural language';
 
 
+--
+-- Name: pg_trgm; Type: EXTENSION; Schema: -; Owner: 
+--
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+
+--
+-- Name: EXTENSION pg_trgm; Type: COMMENT; Schema: -; Owner: 
+--
+
+COMMENT ON EXTENSION pg_trgm IS 'text similarity measurement and index searching based on trigrams';
+
+
 --
 -- Name: gender; Type: TYPE; Schema: public; Owner: pl704206
 --
@@ -60,6 +74,18 @@ CREATE TABLE public.actor (
 
 ALTER TABLE public.actor OWNER TO pl704206;
 
+--
+-- Name: actor_doc; Type: TABLE; Schema: public; Owner: pl704206
+--
+
+CREATE TABLE public.actor_doc (
+    id integer NOT NULL,
+    doc text NOT NULL
+);
+
+
+ALTER TABLE public.actor_doc OWNER TO pl704206;
+
 --
 -- Name: actor_id_seq; Type: SEQUENCE; Schema: public; Owner: pl704206
 --
@@ -98,8 +124,8 @@ ALTER TABLE public.alembic_version OWNER TO pl704206;
 --
 
 CREATE TABLE public.association (
-    movie_id integer,
-    actor_id integer
+    movie_id integer NOT NULL,
+    actor_id integer NOT NULL
 );
 
 
@@ -118,6 +144,31 @@ CREATE TABLE public.movie (
 
 ALTER TABLE public.movie OWNER TO pl704206;
 
+--
+-- Name: movie_doc; Type: TABLE; Schema: public; Owner: pl704206
+--
+
+CREATE TABLE public.movie_doc (
+    id integer NOT NULL,
+    doc text NOT NULL
+);
+
+
+ALTER TABLE public.movie_doc OWNER TO pl704206;
+
+--
+-- Name: resource_version; Type: TABLE; Schema: public; Owner: pl704206
+--
+
+CREATE TABLE public.resource_version (
+    resource character varying(32) NOT NULL,
+    version bigint NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.resource_version OWNER TO pl704206;
+
 --
 -- Name: movie_id_seq; Type: SEQUENCE; Schema: public; Owner: pl704206
 --
@@ -162,12 +213,20 @@ COPY public.actor (id, name, age, gender) FROM stdin;
 \.
 
 
+--
+-- Data for Name: actor_doc; Type: TABLE DATA; Schema: public; Owner: pl704206
+--
+
+COPY public.actor_doc (id, doc) FROM stdin;
+\.
+
+
 --
 -- Data for Name: alembic_version; Type: TABLE DATA; Schema: public; Owner: pl704206
 --
 
 COPY public.alembic_version (version_num) FROM stdin;
-e6b70ef50c6b
+a4c8e2f61d37
 \.
 
 
@@ -187,6 +246,24 @@ COPY public.movie (id, title, date_release) FROM stdin;
 \.
 
 
+--
+-- Data for Name: movie_doc; Type: TABLE DATA; Schema: public; Owner: pl704206
+--
+
+COPY public.movie_doc (id, doc) FROM stdin;
+\.
+
+
+--
+-- Data for Name: resource_version; Type: TABLE DATA; Schema: public; Owner: pl704206
+--
+
+COPY public.resource_version (resource, version, updated_at) FROM stdin;
+actors	0	2026-10-18 11:40:02.906113+00
+movies	0	2026-10-18 11:40:02.906113+00
+\.
+
+
 --
 -- Name: actor_id_seq; Type: SEQUENCE SET; Schema: public; Owner: pl704206
 --
@@ -209,6 +286,14 @@ ALTER TABLE ONLY public.actor
     ADD CONSTRAINT actor_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: actor_doc actor_doc_pkey; Type: CONSTRAINT; Schema: public; Owner: pl704206
+--
+
+ALTER TABLE ONLY public.actor_doc
+    ADD CONSTRAINT actor_doc_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: alembic_version alembic_version_pkc; Type: CONSTRAINT; Schema: public; Owner: pl704206
 --
@@ -217,6 +302,14 @@ ALTER TABLE ONLY public.alembic_version
     ADD CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num);
 
 
+--
+-- Name: association association_pkey; Type: CONSTRAINT; Schema: public; Owner: pl704206
+--
+
+ALTER TABLE ONLY public.association
+    ADD CONSTRAINT association_pkey PRIMARY KEY (movie_id, actor_id);
+
+
 --
 -- Name: movie movie_pkey; Type: CONSTRAINT; Schema: public; Owner: pl704206
 --
@@ -225,6 +318,57 @@ ALTER TABLE ONLY public.movie
     ADD CONSTRAINT movie_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: movie_doc movie_doc_pkey; Type: CONSTRAINT; Schema: public; Owner: pl704206
+--
+
+ALTER TABLE ONLY public.movie_doc
+    ADD CONSTRAINT movie_doc_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: resource_version resource_version_pkey; Type: CONSTRAINT; Schema: public; Owner: pl704206
+--
+
+ALTER TABLE ONLY public.resource_version
+    ADD CONSTRAINT resource_version_pkey PRIMARY KEY (resource);
+
+
+--
+-- Name: ix_actor_age; Type: INDEX; Schema: public; Owner: pl704206
+--
+
+CREATE INDEX ix_actor_age ON public.actor USING btree (age);
+
+
+--
+-- Name: ix_actor_name_trgm; Type: INDEX; Schema: public; Owner: pl704206
+--
+
+CREATE INDEX ix_actor_name_trgm ON public.actor USING gin (name public.gin_trgm_ops);
+
+
+--
+-- Name: ix_association_actor_id_movie_id; Type: INDEX; Schema: public; Owner: pl704206
+--
+
+CREATE INDEX ix_association_actor_id_movie_id ON public.association USING btree (actor_id, movie_id);
+
+
+--
+-- Name: ix_movie_date_release; Type: INDEX; Schema: public; Owner: pl704206
+--
+
+CREATE INDEX ix_movie_date_release ON public.movie USING btree (date_release);
+
+
+--
+-- Name: ix_movie_title_trgm; Type: INDEX; Schema: public; Owner: pl704206
+--
+
+CREATE INDEX ix_movie_title_trgm ON public.movie USING gin (title public.gin_trgm_ops);
+
+
 --
 -- Name: association association_actor_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: pl704206
 --
@@ -1,13 +1,45 @@
+import sys
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import APP
-from models import db
+from models import db, delete_orphan_movies, rebuild_docs, check_docs, READ_MODELS
 
 migrate = Migrate(APP, db)
 manager = Manager(APP)
 
 manager.add_command('db', MigrateCommand)
 
+@manager.command
+def reap_orphans():
+    "Delete all the movies without any actor"
+    count = delete_orphan_movies(db.session)
+    db.session.commit()
+    print(f'{count} orphan movies deleted')
+
+@manager.command
+def rebuild_read_model():
+    "Rebuild the read model of the list endpoints from the tables"
+    for resource in READ_MODELS:
+        count = rebuild_docs(db.session, resource)
+        print(f'{count} {resource} written')
+    db.session.commit()
+
+@manager.command
+def check_read_model():
+    "Compare the read model with the tables, exit with 1 if they differ"
+    consistent = True
+    for resource in READ_MODELS:
+        result = check_docs(db.session, resource)
+        for problem, ids in result.items():
+            if ids:
+                consistent = False
+                print(f'{len(ids)} {resource} {problem}: {ids[:20]}')
+    db.session.rollback()
+    if not consistent:
+        sys.exit(1)
+    print('read model is consistent')
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
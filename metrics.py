@@ -0,0 +1,238 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from itertools import accumulate
+from contextlib import contextmanager
+from flask import g, has_request_context
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+Request metrics
+
+    Time spent in the phases of a request (auth steps, JSON serialization)
+    and in SQL is added up on flask.g while the request runs, and observed
+    into histograms per route once it is over. The histograms are rendered
+    in the Prometheus text format by the /metrics endpoint.
+
+    METRICS_ENABLED=false turns the hooks into no-ops.
+'''
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def format_value(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+'''
+Histogram
+    cumulative bucket counts, sum and count per label values
+'''
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # counts per bucket here, made cumulative when collected
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self._lock:
+            return [(label_values, list(accumulate(counts[:-1])), total, count)
+                    for label_values, (counts, total, count) in sorted(self._series.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, counts, total, count in self.collect():
+            for bound, n in zip(self.buckets + (float('inf'),), counts + [count]):
+                labels = format_labels(self.labels, label_values, [('le', format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {n}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+'''
+CollectedHistogram
+    histogram kept by someone else, collect returns a list of
+    (label values, cumulative bucket counts, sum, count)
+'''
+class CollectedHistogram(Histogram):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, collect=None):
+        super().__init__(name, help, labels, buckets)
+        self.collect = collect
+
+'''
+Gauge
+    values read from a callback when rendered, the callback returns a list
+    of (label values, value)
+'''
+class Gauge:
+    def __init__(self, name, help, labels=(), collect=None, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.type = type
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for label_values, value in self.collect():
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.enabled = METRICS_ENABLED
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        for metric in self.metrics:
+            if type(metric) is Histogram:
+                metric.clear()
+
+METRICS = Registry()
+
+REQUEST_DURATION = METRICS.register(Histogram(
+    'capstone_request_duration_seconds', 'Time to build the response.',
+    ['route', 'method', 'status']))
+PHASE_DURATION = METRICS.register(Histogram(
+    'capstone_request_phase_seconds', 'Time spent in a phase of the request.',
+    ['route', 'method', 'phase']))
+SQL_QUERIES = METRICS.register(Histogram(
+    'capstone_sql_queries_per_request', 'SQL statements executed by a request.',
+    ['route', 'method'], COUNT_BUCKETS))
+SQL_DURATION = METRICS.register(Histogram(
+    'capstone_sql_seconds_per_request', 'Total SQL execution time of a request.',
+    ['route', 'method']))
+SQL_SLOWEST = METRICS.register(Histogram(
+    'capstone_sql_slowest_statement_seconds', 'Slowest SQL statement of a request.',
+    ['route', 'method']))
+
+#
+# Slowest statement seen per route, so the histogram can be traced back to
+# the query. Only the statement text is kept, never its parameters
+#
+SLOWEST_STATEMENTS = {}
+
+METRICS.register(Gauge(
+    'capstone_sql_slowest_statement_max_seconds', 'Slowest SQL statement seen per route.',
+    ['route', 'method', 'statement'],
+    lambda: [((route, method, statement), seconds)
+             for (route, method), (seconds, statement) in sorted(SLOWEST_STATEMENTS.items())]))
+
+@contextmanager
+def timed(phase):
+    #
+    # Add the time spent in the block to the phase of the current request
+    #
+    if not (METRICS.enabled and has_request_context()):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = g.setdefault('metrics_phases', {})
+        phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start
+
+def start_request():
+    if METRICS.enabled:
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql = [0, 0.0, 0.0, None]
+
+def record_statement(seconds, statement):
+    if not (METRICS.enabled and has_request_context()):
+        return
+    sql = g.get('metrics_sql')
+    if sql is None:
+        return
+    sql[0] += 1
+    sql[1] += seconds
+    if seconds > sql[2]:
+        sql[2] = seconds
+        sql[3] = statement
+
+def end_request(route, method, status):
+    start = g.get('metrics_start')
+    if start is None:
+        return
+    g.metrics_start = None
+    REQUEST_DURATION.observe(time.perf_counter() - start, route, method, str(status))
+    for phase, seconds in g.get('metrics_phases', {}).items():
+        PHASE_DURATION.observe(seconds, route, method, phase)
+    count, total, slowest, statement = g.metrics_sql
+    SQL_QUERIES.observe(count, route, method)
+    SQL_DURATION.observe(total, route, method)
+    if count:
+        SQL_SLOWEST.observe(slowest, route, method)
+        if slowest > SLOWEST_STATEMENTS.get((route, method), (0.0, None))[0]:
+            SLOWEST_STATEMENTS[(route, method)] = (slowest, ' '.join(statement.split())[:200])
+
+#
+# SQL statements of every engine, timed from the cursor execute
+#
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if METRICS.enabled:
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_start')
+    if starts:
+        record_statement(time.perf_counter() - starts.pop(), statement)
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    starts = context.connection.info.get('metrics_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+class TimedJSONEncoder(JSONEncoder):
+    #
+    # jsonify encodes through the app json_encoder, time it as serialization
+    #
+    def encode(self, o):
+        with timed('serialize'):
+            return super().encode(o)
@@ -0,0 +1,49 @@
+"""association primary key and reverse index
+
+Revision ID: 3f2a9c7d1b4e
+Revises: e6b70ef50c6b
+Create Date: 2026-10-18 09:12:44.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c7d1b4e'
+down_revision = 'e6b70ef50c6b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # rows with a missing side can not be part of the primary key
+    op.execute('DELETE FROM association WHERE movie_id IS NULL OR actor_id IS NULL')
+    # keep a single row of every duplicated pair
+    op.execute('''
+        DELETE FROM association a
+        USING association b
+        WHERE a.ctid < b.ctid
+          AND a.movie_id = b.movie_id
+          AND a.actor_id = b.actor_id
+    ''')
+    op.alter_column('association', 'movie_id',
+               existing_type=sa.INTEGER(),
+               nullable=False)
+    op.alter_column('association', 'actor_id',
+               existing_type=sa.INTEGER(),
+               nullable=False)
+    op.create_primary_key('association_pkey', 'association', ['movie_id', 'actor_id'])
+    op.create_index('ix_association_actor_id_movie_id', 'association',
+                    ['actor_id', 'movie_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_association_actor_id_movie_id', table_name='association')
+    op.drop_constraint('association_pkey', 'association', type_='primary')
+    op.alter_column('association', 'actor_id',
+               existing_type=sa.INTEGER(),
+               nullable=True)
+    op.alter_column('association', 'movie_id',
+               existing_type=sa.INTEGER(),
+               nullable=True)
@@ -0,0 +1,34 @@
+"""indexes of the list filters
+
+Revision ID: 5b7e1c9a4f2d
+Revises: 8d41b6e2a7c9
+Create Date: 2026-10-18 14:05:31.702918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e1c9a4f2d'
+down_revision = '8d41b6e2a7c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_actor_age', 'actor', ['age'], unique=False)
+    op.create_index('ix_actor_name_trgm', 'actor', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_movie_date_release', 'movie', ['date_release'], unique=False)
+    op.create_index('ix_movie_title_trgm', 'movie', ['title'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    # pg_trgm is left installed, other database objects may use it
+    op.drop_index('ix_movie_title_trgm', table_name='movie')
+    op.drop_index('ix_movie_date_release', table_name='movie')
+    op.drop_index('ix_actor_name_trgm', table_name='actor')
+    op.drop_index('ix_actor_age', table_name='actor')
@@ -0,0 +1,33 @@
+"""resource version table for change tracking
+
+Revision ID: 8d41b6e2a7c9
+Revises: 3f2a9c7d1b4e
+Create Date: 2026-10-18 11:40:02.906113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41b6e2a7c9'
+down_revision = '3f2a9c7d1b4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    resource_version = op.create_table('resource_version',
+    sa.Column('resource', sa.String(length=32), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('resource')
+    )
+    op.bulk_insert(resource_version, [
+        {'resource': 'actors', 'version': 0},
+        {'resource': 'movies', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('resource_version')
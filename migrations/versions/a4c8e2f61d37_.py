@@ -0,0 +1,35 @@
+"""read model tables of the list endpoints
+
+Revision ID: a4c8e2f61d37
+Revises: 5b7e1c9a4f2d
+Create Date: 2026-10-18 16:22:48.415630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c8e2f61d37'
+down_revision = '5b7e1c9a4f2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by manage.py rebuild_read_model
+    op.create_table('actor_doc',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('doc', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('movie_doc',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('doc', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('movie_doc')
+    op.drop_table('actor_doc')
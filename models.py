@@ -1,19 +1,281 @@
+import os
+import copy
 import enum
+import random
+import time
+import logging
+import threading
+import datetime
+from functools import lru_cache
 #from sqlalchemy import Column, String, Integer, DateTime, Enum
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, exc
+from sqlalchemy import orm
+from sqlalchemy.orm import attributes
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 
-db = SQLAlchemy()
+from serialize import dumps
+
+#
+# Read replicas, comma separated database urls. Requests marked with
+# use_replica() read from one of them, everything else (and every flush)
+# goes to DATABASE_URL. A client that wrote within READ_YOUR_WRITES_WINDOW
+# seconds reads from the primary, so it sees its own writes despite the
+# replication lag
+#
+DATABASE_REPLICA_URLS = [u for u in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if u]
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', '5'))
+
+'''
+RoutingSession
+    session sending the reads of a request marked with use_replica() to the
+    replica picked for the request, and everything else to the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not (self.new or self.dirty or self.deleted):
+            replica = get_replica()
+            if replica is not None:
+                return db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+        # the metrics of each pool are kept under the bind of its engine,
+        # a pool is recreated when the engine is disposed
+        pool = engine.pool
+        if isinstance(pool, TimedPoolMixin) and pool.bind is None:
+            pool.bind = bind or 'primary'
+            pool.metrics = POOL_METRICS.setdefault(pool.bind, PoolMetrics())
+            pool.metrics.pool = pool
+        return engine
+
+db = RoutingSQLAlchemy()
+
+def replica_binds(app):
+    return [b for b in app.config.get('SQLALCHEMY_BINDS') or {} if b.startswith('replica_')]
+
+def use_replica():
+    #
+    # Read the rest of the request from a replica, picked once so that all
+    # its queries see the same snapshot
+    #
+    binds = replica_binds(db.get_app())
+    if binds:
+        g.db_replica = random.choice(binds)
+
+def get_replica():
+    return g.get('db_replica') if has_app_context() else None
+
+'''
+ReadYourWrites
+    per process record of when each client last wrote, entries are dropped
+    once the window is over
+'''
+class ReadYourWrites:
+    def __init__(self, window=READ_YOUR_WRITES_WINDOW):
+        self.window = window
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def record(self, client):
+        now = time.monotonic()
+        with self._lock:
+            self._writes[client] = now + self.window
+            if len(self._writes) > 10000:
+                self._writes = {c: t for c, t in self._writes.items() if t > now}
+        return self.window
+
+    def recent(self, client):
+        until = self._writes.get(client)
+        return until is not None and time.monotonic() < until
+
+READ_YOUR_WRITES = ReadYourWrites()
+
+#
+# How movies left without actors are removed. 'incremental' deletes them
+# at the end of the flush that orphaned them, 'batched' collects their ids
+# and deletes them from a background thread every ORPHAN_REAP_INTERVAL seconds
+#
+ORPHAN_SWEEP_MODE = os.getenv('ORPHAN_SWEEP_MODE', 'incremental')
+ORPHAN_REAP_INTERVAL = float(os.getenv('ORPHAN_REAP_INTERVAL', '5'))
+
+#
+# Connection pool of each worker process, every worker holds up to
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections. DB_POOL_MODE=external is for
+# a pooler such as pgbouncer in transaction mode in front of Postgres: a
+# connection is opened per checkout (NullPool), no startup options are sent
+# and the statement timeout is set per transaction
+#
+DB_POOL_MODE = os.getenv('DB_POOL_MODE', 'internal')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '-1'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'false').lower() in ('1', 'true', 'yes')
+# milliseconds, 0 for no limit
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', '0'))
+
+#
+# Group commit. With GROUP_COMMIT on, the writes of the requests arriving
+# within GROUP_COMMIT_WINDOW seconds of each other in a worker are run in a
+# single transaction, up to GROUP_COMMIT_MAX_SIZE of them, each in its own
+# savepoint so a failing write does not undo the others
+#
+GROUP_COMMIT = os.getenv('GROUP_COMMIT', 'false').lower() in ('1', 'true', 'yes')
+GROUP_COMMIT_WINDOW = float(os.getenv('GROUP_COMMIT_WINDOW', '0.002'))
+GROUP_COMMIT_MAX_SIZE = int(os.getenv('GROUP_COMMIT_MAX_SIZE', '64'))
+
+#
+# Read model. With READ_MODEL on, the unfiltered lists are served from
+# actor_doc and movie_doc, which hold the serialized JSON of every actor
+# and movie and are rewritten for the changed rows by each commit. Run
+# manage.py rebuild_read_model before turning it on
+#
+READ_MODEL = os.getenv('READ_MODEL', 'false').lower() in ('1', 'true', 'yes')
+READ_MODEL_BATCH_SIZE = 1000
+
+'''
+PoolMetrics
+    checkout wait time and occupancy of the connection pool of one engine.
+    The wait is the time to get a connection, including opening a new one,
+    and the histogram buckets are cumulative as in Prometheus
+'''
+class PoolMetrics:
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+    def __init__(self):
+        self.pool = None
+        self.checkouts = 0
+        self.timeouts = 0
+        self.in_use = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * len(self.BUCKETS)
+        self._lock = threading.Lock()
+
+    def observe(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_sum += wait
+            self.wait_max = max(self.wait_max, wait)
+            for i, bound in enumerate(self.BUCKETS):
+                if wait <= bound:
+                    self.wait_buckets[i] += 1
+
+    def timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def returned(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def stats(self):
+        stats = {
+            'mode': DB_POOL_MODE,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'in_use': self.in_use,
+            'wait_avg_ms': self.wait_sum / self.checkouts * 1000 if self.checkouts else 0.0,
+            'wait_max_ms': self.wait_max * 1000,
+        }
+        if isinstance(self.pool, QueuePool):
+            stats['size'] = self.pool.size()
+            stats['idle'] = self.pool.checkedin()
+            stats['overflow'] = max(self.pool.overflow(), 0)
+        return stats
+
+# PoolMetrics by bind, 'primary' for DATABASE_URL and replica_<n> for the
+# read replicas
+POOL_METRICS = {}
+
+class TimedPoolMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # labelled by db.get_engine before the first checkout
+        self.bind = None
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeout()
+            raise
+        self.metrics.observe(time.perf_counter() - start)
+        return conn
+
+    def _do_return_conn(self, conn):
+        self.metrics.returned()
+        super()._do_return_conn(conn)
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+class TimedNullPool(TimedPoolMixin, NullPool):
+    pass
+
+@event.listens_for(TimedNullPool, 'checkout')
+def set_local_statement_timeout(dbapi_connection, record, proxy):
+    # opens the transaction the checkout is used for, the pooler may hand
+    # the server connection to another client once it ends
+    if DB_STATEMENT_TIMEOUT:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT}')
+        cursor.close()
+
+def engine_options():
+    options = {
+        # executemany goes through psycopg2 execute_values, many rows per round trip
+        'executemany_mode': 'values',
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    if DB_POOL_MODE == 'external':
+        options['poolclass'] = TimedNullPool
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+    })
+    if DB_STATEMENT_TIMEOUT:
+        options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'}
+    return options
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
 '''
-def setup_db(app, database_path):
+def setup_db(app, database_path, replica_paths=None):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if replica_paths is None:
+        replica_paths = DATABASE_REPLICA_URLS
+    binds = {b: u for b, u in (app.config.get('SQLALCHEMY_BINDS') or {}).items()
+             if not b.startswith('replica_')}
+    binds.update({f'replica_{i}': path for i, path in enumerate(replica_paths)})
+    app.config['SQLALCHEMY_BINDS'] = binds
+    if database_path.startswith('postgres'):
+        options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        for key, value in engine_options().items():
+            options.setdefault(key, value)
     db.app = app
     db.init_app(app)
     # db.create_all()
+    if ORPHAN_SWEEP_MODE == 'batched':
+        ORPHAN_REAPER.start(app)
 
 #
 # Gender Enum type for actor
@@ -22,17 +284,412 @@ class Gender(enum.Enum):
     male = 'M'
     female = 'F'
 
+# serialized value of each gender by name, as stored in the database
+GENDER_VALUES = {g.name: g.value for g in Gender}
+
+#
+# Serialized release date. Movies share few dates, the strings are
+# cached instead of formatted again for every row
+#
+@lru_cache(maxsize=4096)
+def format_date(date):
+    return date.strftime('%Y%m%d')
+
 #
 # The association table to handle the many to many relationship 
-# of Actor and Movie
+# of Actor and Movie. The primary key serves the lookups by movie,
+# the reverse index the lookups by actor
 #
 association_table = db.Table('association',
-    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id')),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id'))
+    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True),
+    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id'), primary_key=True),
+    db.Index('ix_association_actor_id_movie_id', 'actor_id', 'movie_id')
 )
 
+#
+# Tables of the read model, the JSON of each actor and movie as served by
+# the list endpoints, by id
+#
+actor_doc_table = db.Table('actor_doc',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('doc', db.Text, nullable=False)
+)
+
+movie_doc_table = db.Table('movie_doc',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('doc', db.Text, nullable=False)
+)
+
+#
+# Load the related ids of many rows with one grouped query over the
+# association table instead of one relationship load per row. Returns a
+# dict of key id -> sorted list of value ids, rows without relation are
+# left out
+#
+def get_association_ids(key, value, ids):
+    if not ids:
+        return {}
+    values = value
+    if db.engine.dialect.name == 'postgresql':
+        values = aggregate_order_by(value, value)
+    rows = db.session.query(key, db.func.array_agg(values)).\
+        filter(key.in_(ids), value.isnot(None)).\
+        group_by(key).\
+        all()
+    return dict(rows)
+
+#
+# Set the related ids of one row to ids (the current ones if None), plus
+# add and minus remove, inserting and deleting only the association rows
+# that differ, in one statement each. The changes are tracked and the
+# movies that lost an actor swept as a flush would. Raises ValueError
+# before writing if no id would be left and allow_empty is false.
+# Returns the (added, removed) ids
+#
+ASSOCIATION_RESOURCES = {'actor_id': 'actors', 'movie_id': 'movies'}
+
+def update_association_ids(session, key, value, id, ids=None, add=(), remove=(),
+                           allow_empty=True):
+    if ids is None and not add and not remove:
+        return set(), set()
+    current = {row[0] for row in session.query(value).filter(key == id)}
+    ids = (current if ids is None else set(ids)) - set(remove) | set(add)
+    if not ids and not allow_empty:
+        raise ValueError(f'{key.name} {id} would have no {value.name}')
+    added = ids - current
+    removed = current - ids
+    if added:
+        session.execute(association_table.insert(), [
+            {key.name: id, value.name: v} for v in sorted(added)])
+    if removed:
+        session.execute(association_table.delete().
+                        where(key == id).
+                        where(value.in_(sorted(removed))))
+    if added or removed:
+        mark_changed(session, ASSOCIATION_RESOURCES[key.name], {id})
+        mark_changed(session, ASSOCIATION_RESOURCES[value.name], added | removed)
+        if value.name == 'movie_id':
+            sweep_orphans(session, removed)
+        elif removed:
+            sweep_orphans(session, {id})
+    return added, removed
+
+#
+# Rows of the related model joined through the association table to the
+# key ids, as (key id, *related.columns()) ordered by key and related id.
+# after_id and limit page through the related rows
+#
+def get_related_rows(key, value, related, ids, conditions=(), after_id=None, limit=None):
+    query = db.session.query(key, *related.columns()).\
+        select_from(related).\
+        join(association_table, value == related.id).\
+        filter(key.in_(ids), *conditions)
+    if after_id is not None:
+        query = query.filter(related.id > after_id)
+    query = query.order_by(key, related.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+#
+# Change tracking. Every transaction records the rows of the resources
+# ('actors', 'movies') whose serialized form it changed, and the functions
+# in change_listeners are called once it is committed with a dict of
+# resource -> set of ids, or None when any row may have changed. Caches
+# are so never invalidated before the new data is visible.
+#
+# The version of each changed resource in the resource_version table is
+# bumped in the same transaction, so all workers agree on it (used for
+# ETags and the response cache). The bump is done once just before the
+# commit, all resources in one statement locking their rows in the same
+# order, so writers hold the rows only for the commit and can not deadlock
+# on them
+#
+change_listeners = []
+
+def add_change_listener(f):
+    change_listeners.append(f)
+
+def mark_changed(session, resource, ids=None):
+    changed = session.info.setdefault('changed', {})
+    if resource not in changed:
+        changed[resource] = set()
+    if ids is None:
+        changed[resource] = None
+    elif changed[resource] is not None:
+        changed[resource].update(ids)
+
+def mark_flush_changes(session):
+    changed = {'actors': set(), 'movies': set()}
+    # attributes set to the value they had do not change the row
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+    for objs in (session.new, dirty, session.deleted):
+        for obj in objs:
+            if isinstance(obj, Actor):
+                resource, other, key = 'actors', 'movies', 'movies'
+            elif isinstance(obj, Movie):
+                resource, other, key = 'movies', 'actors', 'actors'
+            else:
+                continue
+            changed[resource].add(obj.id)
+            # the id lists of the other side change with the association
+            hist = attributes.get_history(obj, key, attributes.PASSIVE_NO_INITIALIZE)
+            if obj in session.deleted:
+                changed[other].update(o.id for o in hist.sum())
+            else:
+                changed[other].update(o.id for o in (hist.added or ()))
+                changed[other].update(o.id for o in (hist.deleted or ()))
+    for resource, ids in changed.items():
+        ids.discard(None)
+        if ids:
+            mark_changed(session, resource, ids)
+
+# the savepoints of the group commit end without the transaction
+def in_savepoint(session):
+    return session.transaction is not None and session.transaction.nested
+
+@db.event.listens_for(db.session, "before_commit")
+def bump_changed_versions(session):
+    if in_savepoint(session):
+        return
+    # the pending changes are flushed first, they may change more rows
+    session.flush()
+    changed = session.info.get('changed')
+    if changed:
+        ResourceVersion.bump(session, changed)
+
+@db.event.listens_for(db.session, "after_commit")
+def after_commit(session):
+    if in_savepoint(session):
+        return
+    changed = session.info.pop('changed', None)
+    if changed:
+        for f in change_listeners:
+            f(changed)
+
+@db.event.listens_for(db.session, "after_rollback")
+def after_rollback(session):
+    if in_savepoint(session):
+        return
+    session.info.pop('changed', None)
+
+#
+# End the writes of a request. They are committed, or only flushed when
+# run by the group commit which commits them with the rest of the group
+#
+def commit_write(session):
+    if session.info.get('group_commit'):
+        session.flush()
+    else:
+        session.commit()
+
+'''
+GroupWrite
+    write of a request queued for the group commit, with its result or
+    the exception it raised once the group is done
+'''
+class GroupWrite:
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+'''
+GroupCommitter
+    queue of the writes of concurrent requests. The first request of a
+    group leads it: it waits for the window to end or the group to be full,
+    then runs every write of the group with its own session in one
+    transaction and commits once. The other requests wait for their result
+'''
+class GroupCommitter:
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.commits = 0
+        self.writes = 0
+        self._pending = []
+        self._leading = False
+        self._full = threading.Event()
+        self._lock = threading.Lock()
+
+    def submit(self, fn):
+        write = GroupWrite(fn)
+        with self._lock:
+            self._pending.append(write)
+            lead = not self._leading
+            self._leading = True
+            if len(self._pending) >= self.max_size:
+                self._full.set()
+        if lead:
+            self._full.wait(self.window)
+            with self._lock:
+                group, self._pending = self._pending, []
+                self._leading = False
+                self._full.clear()
+            self.run(group)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def run(self, group):
+        session = db.session
+        session.info['group_commit'] = True
+        try:
+            for write in group:
+                # the rows changed so far, the changes of a failing write
+                # are undone with its savepoint
+                changed = copy.deepcopy(session.info.get('changed'))
+                try:
+                    with session.begin_nested():
+                        write.result = write.fn()
+                except Exception as e:
+                    write.error = e
+                    if changed is None:
+                        session.info.pop('changed', None)
+                    else:
+                        session.info['changed'] = changed
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            for write in group:
+                if write.error is None:
+                    write.error = e
+        finally:
+            session.info.pop('group_commit', None)
+            with self._lock:
+                self.commits += 1
+                self.writes += len(group)
+            for write in group:
+                write.done.set()
+
+    def stats(self):
+        return {'commits': self.commits, 'writes': self.writes}
+
+GROUP_COMMITTER = GroupCommitter(GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_SIZE)
+
+#
+# Run the writes of a request, fn, and return its result. The writes are
+# committed by fn, or with the concurrent ones if GROUP_COMMIT is on, and
+# rolled back if it raises
+#
+def run_write(fn):
+    if GROUP_COMMIT:
+        return GROUP_COMMITTER.submit(fn)
+    try:
+        return fn()
+    except:
+        db.session.rollback()
+        raise
+
+#
+# Condition matching the rows of the table whose id is among the ids given.
+# Postgres gets them as one array parameter, id = ANY(:ids), so the
+# statement is the same whatever the number of ids
+#
+def id_in(model, ids):
+    if db.engine.dialect.name != 'postgresql':
+        return model.id.in_(ids)
+    return model.id == db.func.any(
+        db.bindparam('ids', sorted(ids), type_=ARRAY(db.Integer), unique=True))
+
+#
+# Ids of the rows of the table which exist among the ids given, only the
+# ids are read
+#
+def get_existing_ids(model, ids):
+    if not ids:
+        return set()
+    rows = db.session.query(model.id).filter(id_in(model, ids)).all()
+    return {row[0] for row in rows}
+
+#
+# Ids given which have no row in the table, sorted
+#
+def get_missing_ids(model, ids):
+    return sorted(set(ids) - get_existing_ids(model, ids))
+
+#
+# Reserve n ids from the sequence of the table in one round trip, so rows
+# can be bulk inserted with their ids known up front
+#
+def allocate_ids(model, n):
+    rows = db.session.execute(db.text(
+        'SELECT nextval(CAST(:seq AS regclass)) FROM generate_series(1, :n)'),
+        {'seq': f'{model.__tablename__}_id_seq', 'n': n})
+    return [row[0] for row in rows]
+
+#
+# Row count of a table, or of the rows matching the conditions. The
+# estimate comes from the planner statistics and does not scan the table,
+# falls back to count(*) if the table has never been analyzed. Filtered
+# rows are always counted
+#
+def count_rows(model, estimate=False, conditions=()):
+    if estimate and not conditions:
+        count = db.session.execute(db.text(
+            'SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:t AS regclass)'),
+            {'t': model.__tablename__}).scalar()
+        if count is not None and count >= 0:
+            return count
+    return db.session.query(db.func.count(model.id)).filter(*conditions).scalar()
+
+class ResourceVersion(db.Model):
+    __tablename__ = 'resource_version'
+
+    resource = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False,
+                           server_default=db.func.now())
+
+    #
+    # Bump the versions of the resources in one statement, the rows are
+    # locked in the order of their names. updated_at is the time of the
+    # bump, not of the start of the transaction, and always grows even if
+    # a transaction started earlier commits later
+    #
+    @staticmethod
+    def bump(session, resources):
+        table = ResourceVersion.__table__
+        locked = db.select([table.c.resource]).\
+            where(table.c.resource.in_(sorted(resources))).\
+            order_by(table.c.resource).\
+            with_for_update()
+        updated_at = db.func.now()
+        if db.engine.dialect.name == 'postgresql':
+            updated_at = db.func.greatest(
+                db.func.clock_timestamp(),
+                table.c.updated_at + datetime.timedelta(microseconds=1))
+        session.execute(table.update().
+                        where(table.c.resource.in_(locked)).
+                        values(version=table.c.version + 1, updated_at=updated_at))
+
+    #
+    # Return (version, updated_at) of the resource, (0, None) if unknown
+    #
+    @staticmethod
+    def get(resource):
+        table = ResourceVersion.__table__
+        row = db.session.execute(
+            db.select([table.c.version, table.c.updated_at]).
+            where(table.c.resource == resource)).first()
+        return (row[0], row[1]) if row else (0, None)
+
+#
+# The trigram indexes of the name and title searches need pg_trgm, which
+# is created along with the tables
+#
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
 class Movie(db.Model):
     __tablename__ = 'movie'
+    __table_args__ = (
+        db.Index('ix_movie_date_release', 'date_release'),
+        db.Index('ix_movie_title_trgm', 'title', postgresql_using='gin',
+                 postgresql_ops={'title': 'gin_trgm_ops'}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255))
@@ -47,14 +704,39 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write(db.session)
 
     def update(self):
-        db.session.commit()
+        commit_write(db.session)
     
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_write(db.session)
+
+    #
+    # Insert many movies with their actors in a single transaction. movies
+    # is a list of dicts of title, date_release and actors_id, returns the
+    # ids of the new movies in the same order
+    #
+    @staticmethod
+    def bulk_insert(movies):
+        if not movies:
+            return []
+        ids = allocate_ids(Movie, len(movies))
+        db.session.execute(Movie.__table__.insert(), [{
+            'id': id,
+            'title': m['title'],
+            'date_release': m['date_release'],
+        } for id, m in zip(ids, movies)])
+        db.session.execute(association_table.insert(), [{
+            'movie_id': id,
+            'actor_id': actor_id,
+        } for id, m in zip(ids, movies) for actor_id in m['actors_id']])
+        mark_changed(db.session, 'movies', ids)
+        mark_changed(db.session, 'actors', {
+            actor_id for m in movies for actor_id in m['actors_id']})
+        commit_write(db.session)
+        return ids
 
     def get_actors(self):
         actors = []
@@ -62,16 +744,52 @@ class Movie(db.Model):
             actors.append(i.id)
         return actors
 
-    def format(self):
+    def format(self, actors_id=None):
         return {
             'id': self.id, 
             'title': self.title,
             'date_release': self.date_release.strftime('%Y%m%d'),
-            'actors_id': self.get_actors(),
+            'actors_id': self.get_actors() if actors_id is None else actors_id,
         }
 
+    #
+    # Format a list of movies with the actor ids of all of them
+    # loaded in a single query
+    #
+    @staticmethod
+    def format_all(movies):
+        actors_id = get_association_ids(association_table.c.movie_id,
+                                        association_table.c.actor_id,
+                                        [m.id for m in movies])
+        return [m.format(actors_id.get(m.id, [])) for m in movies]
+
+    #
+    # Columns of a movie as a plain row, for format_rows. Same output as
+    # format_all without loading the Movie instances
+    #
+    @staticmethod
+    def columns():
+        return (Movie.id, Movie.title, Movie.date_release)
+
+    @staticmethod
+    def format_rows(rows):
+        actors_id = get_association_ids(association_table.c.movie_id,
+                                        association_table.c.actor_id,
+                                        [r[0] for r in rows])
+        return [{
+            'id': id,
+            'title': title,
+            'date_release': format_date(date_release),
+            'actors_id': actors_id.get(id, []),
+        } for id, title, date_release in rows]
+
 class Actor(db.Model):
     __tablename__ = 'actor'
+    __table_args__ = (
+        db.Index('ix_actor_age', 'age'),
+        db.Index('ix_actor_name_trgm', 'name', postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255))
@@ -85,14 +803,41 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_write(db.session)
 
     def update(self):
-        db.session.commit()
+        commit_write(db.session)
     
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_write(db.session)
+
+    #
+    # Insert many actors with their movies in a single transaction. actors
+    # is a list of dicts of name, age, gender and movies_id, returns the
+    # ids of the new actors in the same order
+    #
+    @staticmethod
+    def bulk_insert(actors):
+        if not actors:
+            return []
+        ids = allocate_ids(Actor, len(actors))
+        db.session.execute(Actor.__table__.insert(), [{
+            'id': id,
+            'name': a['name'],
+            'age': a['age'],
+            'gender': a['gender'],
+        } for id, a in zip(ids, actors)])
+        links = [{
+            'movie_id': movie_id,
+            'actor_id': id,
+        } for id, a in zip(ids, actors) for movie_id in a['movies_id']]
+        if links:
+            db.session.execute(association_table.insert(), links)
+            mark_changed(db.session, 'movies', {link['movie_id'] for link in links})
+        mark_changed(db.session, 'actors', ids)
+        commit_write(db.session)
+        return ids
 
     def get_movies(self):
         movies = []
@@ -100,24 +845,250 @@ class Actor(db.Model):
             movies.append(i.id)
         return movies
 
-    def format(self):
+    def format(self, movies_id=None):
         return {
             'id': self.id, 
             'name': self.name,
             'age': self.age,
             'gender': self.gender.value,
-            'movies_id': self.get_movies(),
+            'movies_id': self.get_movies() if movies_id is None else movies_id,
         }
 
+    #
+    # Format a list of actors with the movie ids of all of them
+    # loaded in a single query
+    #
+    @staticmethod
+    def format_all(actors):
+        movies_id = get_association_ids(association_table.c.actor_id,
+                                        association_table.c.movie_id,
+                                        [a.id for a in actors])
+        return [a.format(movies_id.get(a.id, [])) for a in actors]
+
+    #
+    # Columns of an actor as a plain row, for format_rows. The gender is
+    # read as its name, not converted to the enum
+    #
+    @staticmethod
+    def columns():
+        return (Actor.id, Actor.name, Actor.age, db.type_coerce(Actor.gender, db.String))
+
+    @staticmethod
+    def format_rows(rows):
+        movies_id = get_association_ids(association_table.c.actor_id,
+                                        association_table.c.movie_id,
+                                        [r[0] for r in rows])
+        return [{
+            'id': id,
+            'name': name,
+            'age': age,
+            'gender': GENDER_VALUES[gender],
+            'movies_id': movies_id.get(id, []),
+        } for id, name, age, gender in rows]
+
+#
+# Movies that may have lost their last actor in a flush: the ones whose
+# actors were removed, the ones removed from an actor and the ones of a
+# deleted actor. Only collections already loaded are looked at, a
+# collection that was never loaded can not have been changed
+#
+def get_orphan_candidates(session):
+    ids = set()
+    deleted = set()
+    for obj in session.new:
+        if isinstance(obj, Movie):
+            ids.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Actor):
+            hist = attributes.get_history(obj, 'movies', attributes.PASSIVE_NO_INITIALIZE)
+            ids.update(m.id for m in hist.deleted or ())
+        elif isinstance(obj, Movie):
+            hist = attributes.get_history(obj, 'actors', attributes.PASSIVE_NO_INITIALIZE)
+            if hist.deleted:
+                ids.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Actor):
+            hist = attributes.get_history(obj, 'movies', attributes.PASSIVE_NO_INITIALIZE)
+            ids.update(m.id for m in hist.sum())
+        elif isinstance(obj, Movie):
+            deleted.add(obj.id)
+    ids.discard(None)
+    return ids - deleted
+
+#
+# Delete the movies without any actor, limited to the ids given or the
+# whole table if ids is None
+#
+def delete_orphan_movies(session, ids=None):
+    query = session.query(Movie).filter(~Movie.actors.any())
+    if ids is not None:
+        if not ids:
+            return 0
+        query = query.filter(Movie.id.in_(ids))
+    count = query.delete(synchronize_session=False)
+    if count:
+        mark_changed(session, 'movies', ids)
+    return count
+
 #
-# Event listener to check the table Movie and delete any movie
-# will does not have any actor assiociated with it
+# Background reaper for the batched mode, collects candidate movie ids
+# from the flushes and deletes the orphans in one statement per interval
+#
+class OrphanReaper:
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, ids):
+        with self._lock:
+            self._pending.update(ids)
+
+    def reap(self, app):
+        with self._lock:
+            ids, self._pending = self._pending, set()
+        if not ids:
+            return 0
+        with app.app_context():
+            try:
+                count = delete_orphan_movies(db.session, ids)
+                db.session.commit()
+            except:
+                db.session.rollback()
+                self.add(ids)
+                raise
+            finally:
+                db.session.remove()
+        return count
+
+    def start(self, app):
+        if self._thread is not None:
+            return
+        def run():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.reap(app)
+                except Exception:
+                    logging.exception('orphan movie reaper failed')
+        self._thread = threading.Thread(target=run, name='orphan-reaper', daemon=True)
+        self._thread.start()
+
+ORPHAN_REAPER = OrphanReaper(ORPHAN_REAP_INTERVAL)
+
+#
+# Event listener to delete the movies left without any actor by the flush.
+# Only the movies touched by the flush are checked, not the whole table
 #
 # https://stackoverflow.com/questions/9234082/setting-delete-orphan-on-sqlalchemy-relationship-causes-assertionerror-this-att
 #
 @db.event.listens_for(db.session, "after_flush")
 def after_flush(session, flush_context):
     #print("After flush.......")
-    session.query(Movie).\
-        filter(~Movie.actors.any()).\
-        delete(synchronize_session=False)
\ No newline at end of file
+    mark_flush_changes(session)
+    sweep_orphans(session, get_orphan_candidates(session))
+
+def sweep_orphans(session, ids):
+    if not ids:
+        return
+    if ORPHAN_SWEEP_MODE == 'batched':
+        ORPHAN_REAPER.add(ids)
+    else:
+        delete_orphan_movies(session, ids)
+
+#
+# Read model upkeep. The docs of the rows changed by a transaction are
+# rebuilt from the tables just before it commits, so they are committed
+# with the change. The docs are locked before the rows are read: a
+# concurrent transaction changing the same actor or movie waits, then
+# reads what the first one committed. A resource changed as a whole is
+# rebuilt entirely. The related ids of a doc are sorted
+#
+READ_MODELS = {
+    'actors': (Actor, actor_doc_table, 'movies_id'),
+    'movies': (Movie, movie_doc_table, 'actors_id'),
+}
+
+def build_docs(session, resource, ids):
+    model, table, related_key = READ_MODELS[resource]
+    rows = session.query(*model.columns()).\
+        filter(model.id.in_(ids)).\
+        order_by(model.id).\
+        all()
+    return [{
+        'id': item['id'],
+        'doc': dumps(item).decode(),
+    } for item in model.format_rows(rows)]
+
+def sync_docs(session, resource, ids):
+    model, table, related_key = READ_MODELS[resource]
+    ids = sorted(ids)
+    for i in range(0, len(ids), READ_MODEL_BATCH_SIZE):
+        batch = ids[i:i + READ_MODEL_BATCH_SIZE]
+        session.execute(db.select([table.c.id]).
+                        where(table.c.id.in_(batch)).
+                        order_by(table.c.id).
+                        with_for_update())
+        docs = build_docs(session, resource, batch)
+        session.execute(table.delete().where(table.c.id.in_(batch)))
+        if docs:
+            session.execute(table.insert(), docs)
+
+def rebuild_docs(session, resource):
+    model, table, related_key = READ_MODELS[resource]
+    session.execute(table.delete())
+    count = 0
+    after_id = 0
+    while True:
+        ids = [row[0] for row in session.query(model.id).
+               filter(model.id > after_id).
+               order_by(model.id).
+               limit(READ_MODEL_BATCH_SIZE)]
+        if not ids:
+            return count
+        docs = build_docs(session, resource, ids)
+        session.execute(table.insert(), docs)
+        count += len(docs)
+        after_id = ids[-1]
+
+#
+# Compare the read model of the resource with the docs built from the
+# tables. Returns the ids without doc, with a doc that differs and with a
+# doc but no row
+#
+def check_docs(session, resource):
+    model, table, related_key = READ_MODELS[resource]
+    missing = [row[0] for row in session.query(model.id).
+               filter(~db.exists().where(table.c.id == model.id)).
+               order_by(model.id)]
+    extra = [row[0] for row in session.query(table.c.id).
+             filter(~db.exists().where(model.id == table.c.id)).
+             order_by(table.c.id)]
+    stale = []
+    after_id = 0
+    while True:
+        rows = session.query(table.c.id, table.c.doc).\
+            filter(table.c.id > after_id).\
+            order_by(table.c.id).\
+            limit(READ_MODEL_BATCH_SIZE).\
+            all()
+        if not rows:
+            break
+        docs = {d['id']: d['doc'] for d in build_docs(session, resource, [r[0] for r in rows])}
+        stale.extend(id for id, doc in rows if id in docs and docs[id] != doc)
+        after_id = rows[-1][0]
+    return {'missing': missing, 'stale': stale, 'extra': extra}
+
+@db.event.listens_for(db.session, "before_commit")
+def before_commit(session):
+    if not READ_MODEL or in_savepoint(session):
+        return
+    # flushed by bump_changed_versions, registered first
+    changed = session.info.get('changed') or {}
+    # always in the same order, the locks of two writers can not cross
+    for resource in sorted(changed):
+        if changed[resource] is None:
+            rebuild_docs(session, resource)
+        elif changed[resource]:
+            sync_docs(session, resource, changed[resource])
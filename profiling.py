@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import random
+import marshal
+import pstats
+import cProfile
+import datetime
+import threading
+from collections import Counter, deque
+
+
+'''
+Request profiler
+
+    WSGI middleware keeping the profiles of the last PROFILE_BUFFER_SIZE
+    slow or sampled requests in memory, for GET /profiles.
+
+    PROFILE_THRESHOLD_MS    requests running at least this long are kept,
+                            with the call stacks sampled every
+                            PROFILE_INTERVAL_MS by a background thread.
+                            0 disables it
+    PROFILE_SAMPLE_RATE     fraction of requests run under cProfile and
+                            kept whatever their duration, 0 disables it
+
+    The stack sampler only looks at the threads of running requests and
+    costs little, cProfile slows the requests it runs on several times.
+'''
+PROFILE_THRESHOLD_MS = float(os.getenv('PROFILE_THRESHOLD_MS', '0'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_BUFFER_SIZE = int(os.getenv('PROFILE_BUFFER_SIZE', '20'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+
+def frame_stack(frame, base):
+    # outermost call first, as in the collapsed stack format, from the base
+    # frame on so the server frames below the request are left out
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame))
+        if frame is base:
+            break
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+'''
+StackSampler
+    background thread counting the call stacks of the registered threads
+'''
+class StackSampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, ident, base):
+        stacks = Counter()
+        with self._lock:
+            self._active[ident] = (stacks, base)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler',
+                                                daemon=True)
+                self._thread.start()
+        return stacks
+
+    def stop(self, ident):
+        with self._lock:
+            self._active.pop(ident, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for ident, (stacks, base) in active:
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[frame_stack(frame, base)] += 1
+
+'''
+Profile
+    one profiled request, with the sampled stacks and the cProfile stats
+    when it was run under cProfile
+'''
+class Profile:
+    def __init__(self, id, method, path, status, duration, stacks, stats):
+        self.id = id
+        self.method = method
+        self.path = path
+        self.status = status
+        self.duration = duration
+        self.stacks = stacks
+        self.stats = stats
+        self.created_at = datetime.datetime.utcnow()
+
+    def summary(self):
+        formats = ['collapsed']
+        if self.stats is not None:
+            formats.append('pstats')
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'duration_ms': round(self.duration * 1000, 1),
+            'created_at': self.created_at.isoformat() + 'Z',
+            'samples': sum(self.stacks.values()),
+            'formats': formats,
+        }
+
+    def collapsed(self):
+        # one line per stack, frames separated by ; and the sample count,
+        # the input of flamegraph.pl and speedscope
+        return ''.join(f'{";".join(stack)} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+    def pstats(self):
+        # same bytes as pstats.Stats.dump_stats, loadable with pstats.Stats(path)
+        return marshal.dumps(self.stats)
+
+'''
+RequestProfiler
+    the WSGI middleware, with the ring buffer of the kept profiles
+'''
+class RequestProfiler:
+    # downloading the profiles must not push them out of the buffer
+    EXCLUDE = ('/profiles', '/metrics')
+
+    def __init__(self, app, threshold_ms=PROFILE_THRESHOLD_MS, sample_rate=PROFILE_SAMPLE_RATE,
+                 size=PROFILE_BUFFER_SIZE, interval_ms=PROFILE_INTERVAL_MS):
+        self.app = app
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.sampler = StackSampler(interval_ms / 1000)
+        self.profiles = deque(maxlen=size)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0 or self.sample_rate > 0
+
+    def __call__(self, environ, start_response):
+        if not self.enabled or environ.get('PATH_INFO', '').startswith(self.EXCLUDE):
+            return self.app(environ, start_response)
+
+        status = []
+        def profiled_start_response(s, headers, exc_info=None):
+            status.append(int(s.split(' ', 1)[0]))
+            return start_response(s, headers, exc_info)
+
+        profile = None
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if sampled:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is active in this process
+                profile = None
+        # the stacks are only kept for sampled requests and, when the
+        # threshold is on, for the slow ones
+        ident = threading.get_ident()
+        stacks = None
+        if sampled or self.threshold > 0:
+            stacks = self.sampler.start(ident, sys._getframe())
+        start = time.perf_counter()
+        try:
+            return self.app(environ, profiled_start_response)
+        finally:
+            duration = time.perf_counter() - start
+            if stacks is not None:
+                self.sampler.stop(ident)
+            if profile is not None:
+                profile.disable()
+            if profile is not None or (self.threshold > 0 and duration >= self.threshold):
+                stats = pstats.Stats(profile).stats if profile is not None else None
+                self.keep(environ, status[0] if status else 500, duration, stacks, stats)
+
+    def keep(self, environ, status, duration, stacks, stats):
+        path = environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        with self._lock:
+            self.profiles.append(Profile(self._next_id, environ.get('REQUEST_METHOD'),
+                                         path, status, duration, stacks, stats))
+            self._next_id += 1
+
+    def get(self, id):
+        with self._lock:
+            for profile in self.profiles:
+                if profile.id == id:
+                    return profile
+        return None
+
+    def list(self):
+        with self._lock:
+            return [p.summary() for p in reversed(self.profiles)]
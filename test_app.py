@@ -2,11 +2,17 @@ import os
 import unittest
 import json
 import datetime
+import threading
+from unittest import mock
 #from flask_sqlalchemy import SQLAlchemy
 
 #from app import create_app
-from app import APP
-from models import Actor, Movie, Gender, setup_db
+from werkzeug.datastructures import MultiDict
+from app import APP, get_filters
+from cache import RESPONSE_CACHE, ITEM_CACHE
+from models import Actor, Movie, Gender, setup_db, db, id_in, READ_YOUR_WRITES, GROUP_COMMITTER, \
+    READ_MODELS, ResourceVersion, rebuild_docs, check_docs
+import models
 
 class CapstoneTestCase(unittest.TestCase):
 
@@ -63,10 +69,75 @@ class CapstoneTestCase(unittest.TestCase):
             return wrapper
         return add_jwt_header_decorator
     
+    #
+    # SQL statements sent to the database while f runs
+    #
+    def statements(self, f):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            f()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def count_queries(self, f):
+        return len(self.statements(f))
+
+    def association_writes(self, f):
+        return [s for s in self.statements(f)
+                if s.startswith(('INSERT INTO association', 'UPDATE association',
+                                 'DELETE FROM association'))]
+
+    #
+    # Add n actors, each acting in its own movie
+    #
+    def add_actors_and_movies(self, n):
+        for i in range(n):
+            a = Actor(name=f'Actor {i}', age=30, gender=Gender('F'))
+            a.insert()
+            m = Movie(title=f'Movie {i}', date_release='20200401', actors=[a])
+            m.insert()
+
+    #
+    # Return the plan of the query with sequential scans disabled, so the
+    # plan shows whether an index can serve it even on a tiny table
+    #
+    def explain(self, query):
+        sql = query.statement.compile(dialect=db.engine.dialect,
+                                      compile_kwargs={'literal_binds': True})
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        plan = db.session.execute(f'EXPLAIN {sql}').fetchall()
+        db.session.rollback()
+        return '\n'.join(row[0] for row in plan)
+
     def test_base(self):
         res = self.client().get('/')
         self.assertEqual(res.status_code, 200)
 
+    def test_pool_metrics(self):
+        res = self.client().get('/')
+        data = json.loads(res.data)
+        pool = data['db_pool']['primary']
+        self.assertGreater(pool['checkouts'], 0)
+        self.assertEqual(pool['in_use'], 0)
+        self.assertEqual(pool['timeouts'], 0)
+        self.assertIn('wait_avg_ms', pool)
+
+    @add_jwt_header('assistant')
+    def test_metrics(self, headers):
+        self.client().get('/actors', headers=headers)
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        text = res.data.decode()
+        self.assertIn('capstone_request_duration_seconds_count{route="/actors",method="GET",status="200"}', text)
+        self.assertIn('capstone_sql_queries_per_request_bucket{route="/actors",method="GET"', text)
+        self.assertIn('phase="auth_jwks"', text)
+        self.assertIn('capstone_db_pool_wait_seconds_count', text)
+
     '''
 
     Test for success behavior of each endpoint
@@ -85,6 +156,284 @@ class CapstoneTestCase(unittest.TestCase):
         res = self.client().get('/movies', headers=headers)
         self.assertEqual(res.status_code, 200)
 
+    @add_jwt_header('assistant')
+    def test_get_actors_query_count_is_constant(self, headers):
+
+        #
+        # The number of queries must not grow with the number of actors
+        #
+        responses = []
+        get = lambda: responses.append(self.client().get('/actors', headers=headers))
+        few = self.count_queries(get)
+        self.add_actors_and_movies(10)
+        many = self.count_queries(get)
+        self.assertEqual([res.status_code for res in responses], [200, 200])
+        before, after = [len(json.loads(res.data)['actors']) for res in responses]
+        self.assertEqual(after, before + 10)
+        self.assertEqual(few, many)
+        # the resource version lookup for the ETag and the list query
+        self.assertLessEqual(many, 3)
+
+    @add_jwt_header('assistant')
+    def test_get_movies_query_count_is_constant(self, headers):
+
+        responses = []
+        get = lambda: responses.append(self.client().get('/movies', headers=headers))
+        few = self.count_queries(get)
+        self.add_actors_and_movies(10)
+        many = self.count_queries(get)
+        self.assertEqual([res.status_code for res in responses], [200, 200])
+        before, after = [len(json.loads(res.data)['movies']) for res in responses]
+        self.assertEqual(after, before + 10)
+        self.assertEqual(few, many)
+        # the resource version lookup for the ETag and the list query
+        self.assertLessEqual(many, 3)
+
+    @add_jwt_header('assistant')
+    def test_get_actors_paginated(self, headers):
+
+        #
+        # Walk all the pages of 2 actors with the cursor
+        #
+        self.add_actors_and_movies(4)
+        ids = []
+        cursor = None
+        while True:
+            url = '/actors?limit=2&total=exact' + (f'&cursor={cursor}' if cursor else '')
+            res = self.client().get(url, headers=headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['actors']), 2)
+            self.assertEqual(data['total_actors'], 5)
+            ids += [a['id'] for a in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, sorted(a.id for a in Actor.query.all()))
+
+    @add_jwt_header('assistant')
+    def test_get_movies_paginated(self, headers):
+
+        self.add_actors_and_movies(2)
+        res = self.client().get('/movies?limit=2', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertNotIn('total_movies', data)
+
+        res = self.client().get(f'/movies?limit=2&cursor={data["next_cursor"]}', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 1)
+        self.assertIsNone(data['next_cursor'])
+
+    @add_jwt_header('assistant')
+    def test_get_actors_stream_ndjson(self, headers):
+
+        #
+        # Streamed rows must be the same as the ones of the plain list
+        #
+        self.add_actors_and_movies(3)
+        res = self.client().get('/actors?stream=ndjson', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        actors = [json.loads(l) for l in res.data.decode().splitlines()]
+
+        data = json.loads(self.client().get('/actors', headers=headers).data)
+        self.assertEqual(actors, data['actors'])
+
+    @add_jwt_header('assistant')
+    def test_get_movies_stream_json(self, headers):
+
+        self.add_actors_and_movies(3)
+        res = self.client().get('/movies?stream=json', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        streamed = json.loads(res.data)
+        self.assertEqual(streamed['success'], True)
+
+        data = json.loads(self.client().get('/movies', headers=headers).data)
+        self.assertEqual(streamed['movies'], data['movies'])
+
+    @add_jwt_header('assistant')
+    def test_get_list_same_bytes_as_format_all(self, headers):
+
+        #
+        # The row serializer must send what jsonify of format_all sent
+        #
+        self.add_actors_and_movies(3)
+        Actor(name='Zoë "Ångström"\x7f', age=None, gender=Gender('F')).insert()
+        for model, key in ((Actor, 'actors'), (Movie, 'movies')):
+            res = self.client().get(f'/{key}?limit=100', headers=headers)
+            with self.app.app_context():
+                rows = model.query.order_by(model.id).all()
+                expected = json.dumps({
+                    key: model.format_all(rows),
+                    'next_cursor': None,
+                    'success': True,
+                }, sort_keys=True, separators=(',', ':')) + '\n'
+            self.assertEqual(res.data, expected.encode())
+
+    @add_jwt_header('director')
+    def test_get_actors_cached_until_write(self, headers):
+
+        #
+        # Second read is served from the response cache, a write to
+        # actors invalidates it
+        #
+        res = self.client().get('/actors', headers=headers)
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        res = self.client().post('/actors', headers=headers,
+                                            data=json.dumps({
+                                                'name': 'Lars Larsson',
+                                                'age': 38,
+                                                'gender': 'M'}),
+                                            content_type='application/json')
+        a_id = json.loads(res.data)['actor_id']
+
+        res = self.client().get('/actors', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertIn(a_id, [a['id'] for a in data['actors']])
+
+    @add_jwt_header('director')
+    def test_get_actors_cache_invalidated_by_other_worker(self, headers):
+
+        #
+        # A write committed by another worker only bumps the version in the
+        # database, the entries of this worker are not read anymore
+        #
+        self.client().get('/actors', headers=headers)
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        ResourceVersion.bump(db.session, ['actors'])
+        db.session.commit()
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+
+    @add_jwt_header('producer')
+    def test_get_movies_cache_invalidated_by_actor_delete(self, headers):
+
+        #
+        # Deleting the only actor of a movie orphans it, the cached movie
+        # list must not show it anymore
+        #
+        data = json.loads(self.client().get('/movies', headers=headers).data)
+        self.assertEqual(len(data['movies']), 1)
+
+        Actor.query.all()[0].delete()
+        res = self.client().get('/movies', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['movies'], [])
+
+    @add_jwt_header('director')
+    def test_get_actors_not_modified(self, headers):
+
+        #
+        # Same ETag answers 304 until actors change
+        #
+        res = self.client().get('/actors', headers=headers)
+        etag = res.headers['ETag']
+        res = self.client().get('/actors', headers={**headers, 'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        a = Actor.query.all()[0]
+        a.age = 31
+        a.update()
+        res = self.client().get('/actors', headers={**headers, 'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    @add_jwt_header('assistant')
+    def test_get_movies_not_modified_since(self, headers):
+
+        # the movies were last changed a minute ago
+        db.session.execute("UPDATE resource_version SET updated_at = now() - interval '1 minute'")
+        db.session.commit()
+        res = self.client().get('/movies', headers=headers)
+        last_modified = res.headers['Last-Modified']
+        res = self.client().get('/movies', headers={**headers, 'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 304)
+
+    @add_jwt_header('director')
+    def test_get_movies_modified_in_the_same_second(self, headers):
+
+        #
+        # A write in the second of the Last-Modified date is not answered
+        # with 304, whole second dates can not tell both changes apart
+        #
+        res = self.client().get('/movies', headers=headers)
+        last_modified = res.headers['Last-Modified']
+        m = Movie.query.all()[0]
+        m.title = 'Same second'
+        m.update()
+        res = self.client().get('/movies', headers={**headers, 'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Same second', res.data)
+
+    @add_jwt_header('director')
+    def test_get_actor(self, headers):
+
+        a = Actor.query.all()[0]
+        m = Movie.query.all()[0]
+        res = self.client().get(f'/actors/{a.id}', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['name'], 'Kenneth Torkel')
+        self.assertEqual(data['actor']['movies_id'], [m.id])
+
+        #
+        # The cached actor is dropped by the update
+        #
+        res = self.client().patch(f'/actors/{a.id}', headers=headers,
+                                                     data=json.dumps({
+                                                         'name': 'Kenneth Torkel',
+                                                         'age': 31,
+                                                         'gender': 'M',
+                                                         'movies_id': [m.id]
+                                                     }),
+                                                     content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(self.client().get(f'/actors/{a.id}', headers=headers).data)
+        self.assertEqual(data['actor']['age'], 31)
+
+    @add_jwt_header('director')
+    def test_get_actor_cached_across_other_writes(self, headers):
+
+        #
+        # A write to another actor keeps the cached actor
+        #
+        a = Actor.query.all()[0]
+        self.add_actors_and_movies(1)
+        other = Actor.query.filter(Actor.name == 'Actor 0').one()
+        self.client().get(f'/actors/{a.id}', headers=headers)
+        hits = ITEM_CACHE.hits
+        res = self.client().patch(f'/actors/{other.id}', headers=headers, json={'age': 41})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(f'/actors/{a.id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(ITEM_CACHE.hits, hits + 1)
+
+    @add_jwt_header('producer')
+    def test_get_movie(self, headers):
+
+        a = Actor.query.all()[0]
+        m = Movie.query.all()[0]
+        res = self.client().get(f'/movies/{m.id}', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['actors_id'], [a.id])
+
+        #
+        # Movie is gone with its only actor
+        #
+        self.client().delete(f'/actors/{a.id}', headers=headers)
+        res = self.client().get(f'/movies/{m.id}', headers=headers)
+        self.assertEqual(res.status_code, 404)
+
     @add_jwt_header('director')
     def test_delete_actor(self, headers):
 
@@ -145,6 +494,59 @@ class CapstoneTestCase(unittest.TestCase):
         m = Movie.query.filter(Movie.id == m_id).one_or_none()
         self.assertIsNotNone(m)
     
+    @add_jwt_header('director')
+    def test_add_actors_bulk(self, headers):
+
+        m = Movie.query.all()[0]
+        res = self.client().post('/actors/bulk', headers=headers,
+                                                 data=json.dumps([
+                                                     {'name': 'Lars Larsson', 'age': 38, 'gender': 'M'},
+                                                     {'name': 'Lars Hedmark', 'age': 35, 'gender': 'M',
+                                                      'movies_id': [m.id]},
+                                                     {'age': 45, 'gender': 'M'},
+                                                     {'name': 'Nobody', 'age': 45, 'gender': 'F',
+                                                      'movies_id': [10000]},
+                                                 ]),
+                                                 content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_inserted'], 2)
+        results = data['results']
+        self.assertEqual([r['success'] for r in results], [True, True, False, False])
+        self.assertEqual(results[2]['error'], 400)
+        self.assertEqual(results[3]['error'], 404)
+        self.assertEqual(results[3]['missing_movies_id'], [10000])
+
+        a = Actor.query.filter(Actor.id == results[1]['actor_id']).one_or_none()
+        self.assertEqual(a.get_movies(), [m.id])
+
+    @add_jwt_header('producer')
+    def test_add_movies_bulk(self, headers):
+
+        a = Actor.query.all()[0]
+        res = self.client().post('/movies/bulk', headers=headers,
+                                                 data=json.dumps([
+                                                     {'title': 'Genesis II', 'date_release': '20200328',
+                                                      'actors_id': [a.id]},
+                                                     {'title': 'Genesis III', 'date_release': '20200328',
+                                                      'actors_id': []},
+                                                 ]),
+                                                 content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_inserted'], 1)
+        m = Movie.query.filter(Movie.id == data['results'][0]['movie_id']).one_or_none()
+        self.assertEqual(m.get_actors(), [a.id])
+        self.assertEqual(data['results'][1]['error'], 400)
+
+    @add_jwt_header('director')
+    def test_400_bad_body_add_actors_bulk(self, headers):
+
+        res = self.client().post('/actors/bulk', headers=headers,
+                                                 data=json.dumps({'name': 'Lars Larsson'}),
+                                                 content_type='application/json')
+        self.assertEqual(res.status_code, 400)
+
     @add_jwt_header('director')
     def test_patch_actor(self, headers):
 
@@ -203,6 +605,454 @@ class CapstoneTestCase(unittest.TestCase):
         m1 = Movie.query.filter(Movie.id == m.id).one_or_none()
         self.assertEqual(m1.date_release, datetime.datetime.strptime('20200328', '%Y%m%d').date())
 
+    @add_jwt_header('director')
+    def test_orphan_movie_deleted_with_last_actor(self, headers):
+
+        #
+        # Movie acted only by the deleted actor is deleted, the movie
+        # acted by another actor as well stays
+        #
+        a1 = Actor(name='Lars Larsson', age=38, gender=Gender('M'))
+        a1.insert()
+        a2 = Actor(name='Lars Hedmark', age=35, gender=Gender('M'))
+        a2.insert()
+        m1 = Movie(title='Solo', date_release='20200320', actors=[a1])
+        m1.insert()
+        m2 = Movie(title='Duo', date_release='20200320', actors=[a1, a2])
+        m2.insert()
+        m1_id, m2_id = m1.id, m2.id
+
+        res = self.client().delete(f'/actors/{a1.id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(Movie.query.filter(Movie.id == m1_id).one_or_none())
+        self.assertIsNotNone(Movie.query.filter(Movie.id == m2_id).one_or_none())
+
+    def test_insert_actor_does_not_sweep_movies(self):
+
+        #
+        # Adding an actor without movies can not orphan a movie, no delete
+        # must be sent
+        #
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            Actor(name='Lars Larsson', age=38, gender=Gender('M')).insert()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertFalse([s for s in statements if s.lstrip().upper().startswith('DELETE')])
+
+    @unittest.skipUnless(os.getenv('TEST_REPLICA_DATABASE_URL'), 'no replica database')
+    @add_jwt_header('producer')
+    def test_read_replica_routing(self, headers):
+
+        #
+        # The replica is a second, empty database that is not replicated, so
+        # a read served by it does not see the actor added by setUp
+        #
+        setup_db(self.app, os.environ['TEST_DATABASE_URL'],
+                 [os.environ['TEST_REPLICA_DATABASE_URL']])
+        try:
+            db.metadata.create_all(db.get_engine(self.app, 'replica_0'))
+            READ_YOUR_WRITES._writes.clear()
+            res = self.client().get('/actors', headers=headers)
+            self.assertEqual(json.loads(res.data)['total_actors'], 0)
+
+            # a client that just wrote reads from the primary
+            client = self.client()
+            res = client.post('/actors', headers=headers, json={
+                'name': 'Mia Ek', 'age': 25, 'gender': 'F'})
+            self.assertEqual(res.status_code, 200)
+            res = client.get('/actors', headers=headers)
+            self.assertEqual(json.loads(res.data)['total_actors'], 2)
+        finally:
+            setup_db(self.app, os.environ['TEST_DATABASE_URL'], [])
+
+    def test_explain_existence_checks_use_index(self):
+
+        #
+        # Queries of check_movies_exist and check_actors_exist
+        #
+        plan = self.explain(db.session.query(Movie.id).filter(id_in(Movie, [1, 2, 3])))
+        self.assertIn('movie_pkey', plan)
+        plan = self.explain(db.session.query(Actor.id).filter(id_in(Actor, [1, 2, 3])))
+        self.assertIn('actor_pkey', plan)
+
+    @add_jwt_header('director')
+    def test_group_commit(self, headers):
+
+        #
+        # Concurrent writes are committed together, a write that fails is
+        # rolled back alone and its request still gets its own error
+        #
+        m_id = Movie.query.all()[0].id
+        a_id = Actor.query.all()[0].id
+        db.session.remove()
+        commits = GROUP_COMMITTER.commits
+        results = {}
+
+        def post(i):
+            if i == 0:
+                # the movie would be left without actors
+                res = self.client().patch(f'/movies/{m_id}', headers=headers,
+                                          json={'remove_actors_id': [a_id]})
+            else:
+                res = self.client().post('/actors', headers=headers, json={
+                    'name': f'Actor {i}', 'age': 30, 'gender': 'F'})
+            results[i] = res.status_code
+
+        with mock.patch.object(models, 'GROUP_COMMIT', True), \
+                mock.patch.object(GROUP_COMMITTER, 'window', 0.2):
+            threads = [threading.Thread(target=post, args=(i,)) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(results, {0: 400, **{i: 200 for i in range(1, 8)}})
+        self.assertLess(GROUP_COMMITTER.commits - commits, 7)
+        self.assertEqual(Actor.query.filter(Actor.name.like('Actor %')).count(), 7)
+        self.assertEqual(Movie.query.filter(Movie.id == m_id).one().get_actors(), [a_id])
+
+    @add_jwt_header('director')
+    def test_read_model(self, headers):
+
+        def lists():
+            return [self.client().get(path, headers=headers).data
+                    for path in ('/actors', '/movies?limit=1', '/actors?stream=json',
+                                 '/movies?stream=ndjson')]
+
+        def check():
+            return [check_docs(db.session, resource) for resource in READ_MODELS]
+
+        consistent = [{'missing': [], 'stale': [], 'extra': []}] * 2
+        live = lists()
+        try:
+            with mock.patch.object(models, 'READ_MODEL', True):
+                for resource in READ_MODELS:
+                    rebuild_docs(db.session, resource)
+                db.session.commit()
+                self.assertEqual(check(), consistent)
+
+                # same bytes, read from the read model alone
+                with mock.patch.object(RESPONSE_CACHE, 'backend', None):
+                    statements = self.statements(lambda: self.assertEqual(lists(), live))
+                selects = [s for s in statements if 'FROM actor' in s or 'FROM movie' in s]
+                self.assertEqual(len(selects), 4)
+                self.assertTrue(all('_doc' in s for s in selects))
+
+                # the writes keep it up to date
+                m_id = Movie.query.all()[0].id
+                a_id = Actor.query.all()[0].id
+                db.session.remove()
+                res = self.client().post('/actors', headers=headers, json={
+                    'name': 'Mia Ek', 'age': 25, 'gender': 'F', 'movies_id': [m_id]})
+                self.assertEqual(res.status_code, 200)
+                res = self.client().patch(f'/movies/{m_id}', headers=headers,
+                                          json={'title': 'Genesis II'})
+                self.assertEqual(res.status_code, 200)
+                res = self.client().delete(f'/actors/{a_id}', headers=headers)
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(check(), consistent)
+                movies = json.loads(self.client().get('/movies', headers=headers).data)
+                self.assertEqual(movies['movies'][0]['title'], 'Genesis II')
+        finally:
+            for resource, (model, table, related_key) in READ_MODELS.items():
+                db.session.execute(table.delete())
+            db.session.commit()
+
+    @add_jwt_header('director')
+    def test_post_checks_only_ids(self, headers):
+
+        #
+        # The existence check reads the ids alone with one array parameter,
+        # and the movies are linked without being loaded
+        #
+        m_id = Movie.query.all()[0].id
+        res = []
+        statements = self.statements(lambda: res.append(self.client().post(
+            '/actors', headers=headers,
+            json={'name': 'Mia Ek', 'age': 25, 'gender': 'F', 'movies_id': [m_id]})))
+        self.assertEqual(res[0].status_code, 200)
+        selects = [s for s in statements if 'FROM movie' in s]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('= any(', selects[0])
+        self.assertNotIn('movie.title', selects[0])
+        a_id = json.loads(res[0].data)['actor_id']
+        self.assertEqual(Actor.query.filter(Actor.id == a_id).one().get_movies(), [m_id])
+
+    @add_jwt_header('director')
+    def test_404_reports_missing_ids(self, headers):
+
+        m_id = Movie.query.all()[0].id
+        a_id = Actor.query.all()[0].id
+        res = self.client().post('/actors', headers=headers, json={
+            'name': 'Mia Ek', 'age': 25, 'gender': 'F', 'movies_id': [m_id, 10001, 10000]})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['missing_movies_id'], [10000, 10001])
+
+        res = self.client().post('/movies', headers=headers, json={
+            'title': 'Exodus', 'date_release': '20200401', 'actors_id': [a_id, 10000]})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['missing_actors_id'], [10000])
+
+        res = self.client().patch(f'/movies/{m_id}', headers=headers,
+                                  json={'add_actors_id': [10000]})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['missing_actors_id'], [10000])
+
+    def test_explain_relationship_loads_use_index(self):
+
+        m = Movie.query.all()[0]
+        a = Actor.query.all()[0]
+
+        # Movie.actors looks the association up by movie_id
+        plan = self.explain(Actor.query.with_parent(m, 'actors'))
+        self.assertIn('association_pkey', plan)
+
+        # Actor.movies looks the association up by actor_id
+        plan = self.explain(Movie.query.with_parent(a, 'movies'))
+        self.assertIn('ix_association_actor_id_movie_id', plan)
+
+    def test_explain_list_filters_use_index(self):
+
+        def filtered(model, **args):
+            return model.query.filter(*get_filters(model, MultiDict(args)))
+
+        plan = self.explain(filtered(Actor, age_min='30', age_max='40'))
+        self.assertIn('ix_actor_age', plan)
+        plan = self.explain(filtered(Actor, name_prefix='Ken'))
+        self.assertIn('ix_actor_name_trgm', plan)
+        plan = self.explain(filtered(Actor, name_contains='Tork'))
+        self.assertIn('ix_actor_name_trgm', plan)
+        plan = self.explain(filtered(Movie, title_contains='enes'))
+        self.assertIn('ix_movie_title_trgm', plan)
+        # dates have no literal form for the plan, the same condition cast
+        plan = self.explain(Movie.query.filter(
+            Movie.date_release >= db.cast('2020-01-01', db.Date),
+            Movie.date_release <= db.cast('2020-12-31', db.Date)))
+        self.assertIn('ix_movie_date_release', plan)
+
+    @add_jwt_header('assistant')
+    def test_get_actors_filtered(self, headers):
+
+        Actor(name='Anna 100%_x', age=35, gender=Gender('F')).insert()
+        Actor(name='anne', age=41, gender=Gender('F')).insert()
+
+        def names(query):
+            res = self.client().get(f'/actors?{query}', headers=headers)
+            self.assertEqual(res.status_code, 200)
+            return sorted(a['name'] for a in json.loads(res.data)['actors'])
+
+        self.assertEqual(names('age_min=30&age_max=40'), ['Anna 100%_x', 'Kenneth Torkel'])
+        self.assertEqual(names('gender=F'), ['Anna 100%_x', 'anne'])
+        self.assertEqual(names('name_prefix=ann'), ['Anna 100%_x', 'anne'])
+        # % and _ are matched as themselves
+        self.assertEqual(names('name_contains=100%25_'), ['Anna 100%_x'])
+        self.assertEqual(names('gender=F&age_min=40'), ['anne'])
+
+        res = self.client().get('/actors?gender=F&limit=1&total=exact', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['total_actors'], 2)
+
+    @add_jwt_header('assistant')
+    def test_get_movies_filtered(self, headers):
+
+        a = Actor.query.all()[0]
+        Movie(title='The Gene', date_release='20190101', actors=[a]).insert()
+        Movie(title='Zed', date_release='20201231', actors=[a]).insert()
+
+        def titles(query):
+            res = self.client().get(f'/movies?{query}', headers=headers)
+            self.assertEqual(res.status_code, 200)
+            return sorted(m['title'] for m in json.loads(res.data)['movies'])
+
+        self.assertEqual(titles('date_release_from=20200101&date_release_to=20201231'),
+                         ['Genesis', 'Zed'])
+        self.assertEqual(titles('title_prefix=gen'), ['Genesis'])
+        self.assertEqual(titles('title_contains=GENE'), ['Genesis', 'The Gene'])
+
+    @add_jwt_header('assistant')
+    def test_get_actor_movies(self, headers):
+
+        a = Actor.query.all()[0]
+        a_id = a.id
+        self.add_actors_and_movies(2)
+        for i in range(3):
+            Movie(title=f'Film {i}', date_release='20200401', actors=[a]).insert()
+        expected = sorted(m.id for m in Movie.query.with_parent(a, 'movies'))
+
+        res = self.client().get(f'/actors/{a_id}/movies', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['id'] for m in data['movies']], expected)
+        self.assertEqual(data['total_movies'], 4)
+        self.assertIn(a_id, data['movies'][0]['actors_id'])
+
+        # walk the pages of 3 movies
+        res = self.client().get(f'/actors/{a_id}/movies?limit=3', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['movies']), 3)
+        res = self.client().get(f'/actors/{a_id}/movies?limit=3&cursor={data["next_cursor"]}',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual([m['id'] for m in data['movies']], expected[3:])
+        self.assertIsNone(data['next_cursor'])
+
+    @add_jwt_header('assistant')
+    def test_get_movie_actors(self, headers):
+
+        m_id = Movie.query.all()[0].id
+        res = self.client().get(f'/movies/{m_id}/actors', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['name'] for a in data['actors']], ['Kenneth Torkel'])
+
+    @add_jwt_header('assistant')
+    def test_get_actors_movies_batch_query_count_is_constant(self, headers):
+
+        #
+        # The filmographies of many actors are read with the same queries
+        # as the one of a single actor
+        #
+        self.add_actors_and_movies(10)
+        ids = [a.id for a in Actor.query.order_by(Actor.id)]
+        few = self.count_queries(lambda: self.client().get(
+            f'/actors/movies?ids={ids[0]}', headers=headers))
+        res = []
+        many = self.count_queries(lambda: res.append(self.client().get(
+            f'/actors/movies?ids={",".join(map(str, ids))}', headers=headers)))
+        self.assertEqual(few, many)
+
+        data = json.loads(res[0].data)
+        self.assertEqual(res[0].status_code, 200)
+        self.assertEqual(sorted(data['movies']), sorted(str(id) for id in ids))
+        for id in ids:
+            self.assertEqual([m['actors_id'] for m in data['movies'][str(id)]], [[id]])
+
+    @add_jwt_header('assistant')
+    def test_404_related_of_missing(self, headers):
+
+        for path in ('/actors/100000/movies', '/movies/100000/actors',
+                     '/actors/movies?ids=100000'):
+            res = self.client().get(path, headers=headers)
+            self.assertEqual(res.status_code, 404)
+
+    @add_jwt_header('assistant')
+    def test_400_bad_ids(self, headers):
+
+        for path in ('/actors/movies', '/actors/movies?ids=1,x', '/movies/actors?ids='):
+            res = self.client().get(path, headers=headers)
+            self.assertEqual(res.status_code, 400)
+
+    @add_jwt_header('director')
+    def test_update_actor_unchanged_movies_writes_no_association(self, headers):
+
+        a = Actor.query.all()[0]
+        a_id = a.id
+        for i in range(5):
+            Movie(title=f'Film {i}', date_release='20200401', actors=[a]).insert()
+        movies_id = [m.id for m in Movie.query.with_parent(a, 'movies')]
+        body = {'name': 'Kenneth Torkel', 'age': 31, 'gender': 'M', 'movies_id': movies_id}
+
+        res = []
+        writes = self.association_writes(lambda: res.append(
+            self.client().patch(f'/actors/{a_id}', json=body, headers=headers)))
+        self.assertEqual(res[0].status_code, 200)
+        self.assertEqual(writes, [])
+
+        # one movie less and one more: one delete and one insert
+        other = Actor(name='Mia Ek', age=25, gender=Gender('F'))
+        other.insert()
+        m = Movie(title='Another', date_release='20200401', actors=[other])
+        m.insert()
+        body['movies_id'] = movies_id[1:] + [m.id]
+        writes = self.association_writes(lambda: self.client().patch(
+            f'/actors/{a_id}', json=body, headers=headers))
+        self.assertEqual(len(writes), 2)
+        a = Actor.query.filter(Actor.id == a_id).one()
+        self.assertEqual(sorted(a.get_movies()), sorted(body['movies_id']))
+
+    @add_jwt_header('director')
+    def test_update_movie_unchanged_actors_writes_no_association(self, headers):
+
+        m = Movie.query.all()[0]
+        m_id = m.id
+        body = {'title': 'Genesis 2', 'date_release': '20200328',
+                'actors_id': m.get_actors()}
+        res = []
+        writes = self.association_writes(lambda: res.append(
+            self.client().patch(f'/movies/{m_id}', json=body, headers=headers)))
+        self.assertEqual(res[0].status_code, 200)
+        self.assertEqual(writes, [])
+
+    @add_jwt_header('director')
+    def test_patch_actor_partial_is_one_update(self, headers):
+
+        #
+        # Changing the age alone sends a single UPDATE of the actor, and
+        # neither loads nor checks its movies
+        #
+        a_id = Actor.query.all()[0].id
+        res = []
+        statements = self.statements(lambda: res.append(self.client().patch(
+            f'/actors/{a_id}', json={'age': 45}, headers=headers)))
+        self.assertEqual(res[0].status_code, 200)
+        actor_statements = [s for s in statements if 'actor' in s and 'resource_version' not in s]
+        self.assertEqual(len(actor_statements), 1)
+        self.assertTrue(actor_statements[0].startswith('UPDATE actor SET age='))
+        self.assertNotIn('movie', ' '.join(statements))
+
+        a = Actor.query.filter(Actor.id == a_id).one()
+        self.assertEqual((a.name, a.age), ('Kenneth Torkel', 45))
+
+    @add_jwt_header('director')
+    def test_patch_actor_add_and_remove_movies(self, headers):
+
+        a = Actor.query.all()[0]
+        a_id = a.id
+        other = Actor(name='Mia Ek', age=25, gender=Gender('F'))
+        other.insert()
+        m1 = Movie(title='Film 1', date_release='20200401', actors=[other])
+        m1.insert()
+        m2 = Movie(title='Film 2', date_release='20200401', actors=[other, a])
+        m2.insert()
+        m1_id, m2_id = m1.id, m2.id
+
+        res = []
+        writes = self.association_writes(lambda: res.append(self.client().patch(
+            f'/actors/{a_id}', headers=headers,
+            json={'add_movies_id': [m1_id], 'remove_movies_id': [m2_id]})))
+        self.assertEqual(res[0].status_code, 200)
+        self.assertEqual(len(writes), 2)
+        movies_id = Actor.query.filter(Actor.id == a_id).one().get_movies()
+        self.assertIn(m1_id, movies_id)
+        self.assertNotIn(m2_id, movies_id)
+
+        # a movie to add must exist
+        res = self.client().patch(f'/actors/{a_id}', headers=headers,
+                                  json={'add_movies_id': [100000]})
+        self.assertEqual(res.status_code, 404)
+
+    @add_jwt_header('director')
+    def test_update_actor_removing_last_actor_deletes_movie(self, headers):
+
+        a_id = Actor.query.all()[0].id
+        body = {'name': 'Kenneth Torkel', 'age': 30, 'gender': 'M', 'movies_id': []}
+        res = self.client().patch(f'/actors/{a_id}', json=body, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Movie.query.count(), 0)
+
+    @add_jwt_header('assistant')
+    def test_400_bad_list_filter(self, headers):
+
+        for path in ('/actors?age_min=thirty', '/actors?gender=X',
+                     '/movies?date_release_from=2020'):
+            res = self.client().get(path, headers=headers)
+            self.assertEqual(res.status_code, 400)
+
     '''
 
     Test of error behavior of each end point
@@ -219,6 +1069,30 @@ class CapstoneTestCase(unittest.TestCase):
         res = self.client().get('/movies')
         self.assertEqual(res.status_code, 401)
 
+    @add_jwt_header('assistant')
+    def test_400_bad_cursor_get_actors(self, headers):
+
+        res = self.client().get('/actors?cursor=not-a-cursor', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    @add_jwt_header('assistant')
+    def test_400_bad_limit_get_movies(self, headers):
+
+        res = self.client().get('/movies?limit=0', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    @add_jwt_header('assistant')
+    def test_404_actor_does_not_exist_get_actor(self, headers):
+
+        res = self.client().get('/actors/10000', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     @add_jwt_header('director')
     def test_404_actor_does_not_exist_delete_actor(self, headers):
 
@@ -278,12 +1152,12 @@ class CapstoneTestCase(unittest.TestCase):
     def test_400_bad_input_request_patch_actor(self, headers):
 
         #
-        # patch actor but with missing name
+        # patch actor but with an age that is not a number
         #
         a = Actor.query.all()[0]
         res = self.client().patch(f'/actors/{a.id}', headers=headers,
                                                      data=json.dumps({
-                                                         'age': 45,
+                                                         'age': 'forty five',
                                                          'gender': 'M'
                                                      }),
                                                      content_type='application/json')
@@ -291,6 +1165,25 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data['success'], False)
 
+        #
+        # nothing to update, or the same movie added and removed
+        #
+        for body in ({'nickname': 'Ken'},
+                     {'add_movies_id': [1], 'remove_movies_id': [1]}):
+            res = self.client().patch(f'/actors/{a.id}', headers=headers, json=body)
+            self.assertEqual(res.status_code, 400)
+
+    @add_jwt_header('director')
+    def test_400_patch_movie_without_actors(self, headers):
+
+        m = Movie.query.all()[0]
+        m_id = m.id
+        actors_id = m.get_actors()
+        for body in ({'actors_id': []}, {'remove_actors_id': actors_id}):
+            res = self.client().patch(f'/movies/{m_id}', headers=headers, json=body)
+            self.assertEqual(res.status_code, 400)
+        self.assertEqual(Movie.query.filter(Movie.id == m_id).one().get_actors(), actors_id)
+
     @add_jwt_header('producer')
     def test_404_movie_does_not_exist_patch_movie(self, headers):
 
@@ -336,6 +1229,13 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'Action forbidden.')
         self.assertEqual(data['success'], False)
 
+    @add_jwt_header('producer')
+    def test_rbac_401_producer_forbidden_get_profiles(self, headers):
+        res = self.client().get('/profiles', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+
     @add_jwt_header('director')
     def test_rbac_director_post_actor(self, headers):
 
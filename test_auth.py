@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import base64
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from jose import jwt
+from Crypto.PublicKey import RSA
+
+import auth
+from auth import AuthError, JWKSCache, VerifiedTokenCache, verify_decode_jwt, \
+    verify_decode_jwt_cached
+
+#
+# Helpers to sign our own tokens and serve the matching JWKS
+#
+
+def b64_int(i):
+    b = i.to_bytes((i.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(b).rstrip(b'=').decode()
+
+def make_key(kid):
+    key = RSA.generate(2048)
+    jwk = {
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'n': b64_int(key.n),
+        'e': b64_int(key.e)
+    }
+    return key.exportKey('PEM').decode(), jwk
+
+def make_token(pem, kid, permissions=[], exp=3600):
+    return jwt.encode({
+        'iss': f'https://{auth.AUTH0_DOMAIN}/',
+        'aud': auth.API_AUDIENCE,
+        'exp': int(time.time()) + exp,
+        'permissions': permissions
+    }, pem, algorithm='RS256', headers={'kid': kid})
+
+class JWKSServer:
+    #
+    # Local stub of the identity provider JWKS endpoint, counts the fetches.
+    # down answers every fetch with a 503
+    #
+    def __init__(self, jwks, cache_control=None, delay=0):
+        self.jwks = jwks
+        self.cache_control = cache_control
+        self.delay = delay
+        self.down = False
+        self.hits = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.hits += 1
+                time.sleep(stub.delay)
+                if stub.down:
+                    self.send_error(503)
+                    return
+                body = json.dumps(stub.jwks).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if stub.cache_control:
+                    self.send_header('Cache-Control', stub.cache_control)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/.well-known/jwks.json'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class JWKSCacheTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, cls.jwk = make_key('key-1')
+        cls.pem2, cls.jwk2 = make_key('key-2')
+
+    def setUp(self):
+        self.server = JWKSServer({'keys': [self.jwk]})
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_keys_are_cached(self):
+        cache = JWKSCache(self.server.url)
+        for i in range(10):
+            self.assertEqual(cache.get_key('key-1')['n'], self.jwk['n'])
+        self.assertEqual(self.server.hits, 1)
+
+    def test_file_url(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'keys': [self.jwk]}, f)
+        try:
+            cache = JWKSCache('file://' + f.name)
+            self.assertIsNotNone(cache.get_key('key-1'))
+        finally:
+            os.unlink(f.name)
+
+    def test_unreachable_provider(self):
+        # no keys yet, the client gets a 503
+        cache = JWKSCache('file:///nonexistent/jwks.json')
+        with self.assertRaises(AuthError) as cm:
+            cache.get_key('key-1')
+        self.assertEqual(cm.exception.status_code, 503)
+
+        # keys already fetched are kept
+        cache = JWKSCache(self.server.url, ttl=0, min_refresh_interval=0)
+        cache.get_key('key-1')
+        cache.url = 'file:///nonexistent/jwks.json'
+        self.assertEqual(cache.get_key('key-1')['n'], self.jwk['n'])
+
+    def test_provider_down_for_concurrent_requests(self):
+        #
+        # Every thread waiting on the failed fetch, and every request
+        # inside the refresh interval after it, gets the 503
+        #
+        self.server.down = True
+        self.server.delay = 0.2
+        cache = JWKSCache(self.server.url, min_refresh_interval=60)
+        errors = []
+        def get_key():
+            try:
+                cache.get_key('key-1')
+                errors.append(None)
+            except AuthError as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=get_key) for i in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        get_key()
+        self.assertEqual(self.server.hits, 1)
+        self.assertEqual(len(errors), 9)
+        for err in errors:
+            self.assertIsNotNone(err)
+            self.assertEqual(err.status_code, 503)
+            self.assertEqual(err.error['code'], 'jwks_unavailable')
+
+    def test_cache_control_max_age(self):
+        self.server.cache_control = 'public, max-age=0'
+        cache = JWKSCache(self.server.url, ttl=600, min_refresh_interval=0)
+        cache.get_key('key-1')
+        cache.get_key('key-1')
+        self.assertEqual(self.server.hits, 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        cache = JWKSCache(self.server.url, min_refresh_interval=60)
+        cache.get_key('key-1')
+
+        # key rotated at the identity provider, picked up on the next refresh
+        self.server.jwks = {'keys': [self.jwk, self.jwk2]}
+        cache._last_fetch -= 60
+        self.assertIsNotNone(cache.get_key('key-2'))
+        self.assertEqual(self.server.hits, 2)
+
+        # a bogus kid does not trigger another fetch inside the interval
+        self.assertIsNone(cache.get_key('bogus'))
+        self.assertIsNone(cache.get_key('bogus'))
+        self.assertEqual(self.server.hits, 2)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        self.server.delay = 0.2
+        cache = JWKSCache(self.server.url)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_key('key-1')))
+                   for i in range(10)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(self.server.hits, 1)
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(results))
+
+    def test_verify_decode_jwt(self):
+        cache, auth.JWKS_CACHE = auth.JWKS_CACHE, JWKSCache(self.server.url)
+        try:
+            payload = verify_decode_jwt(make_token(self.pem, 'key-1', ['get:actors']))
+            self.assertEqual(payload['permissions'], ['get:actors'])
+            with self.assertRaises(AuthError):
+                verify_decode_jwt(make_token(self.pem2, 'key-2'))
+        finally:
+            auth.JWKS_CACHE = cache
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, cls.jwk = make_key('key-1')
+        cls.pem2, cls.jwk2 = make_key('key-2')
+
+    def setUp(self):
+        self.server = JWKSServer({'keys': [self.jwk]})
+        self.saved = auth.JWKS_CACHE, auth.TOKEN_CACHE
+        auth.JWKS_CACHE = JWKSCache(self.server.url, min_refresh_interval=0)
+        auth.TOKEN_CACHE = VerifiedTokenCache(2)
+
+    def tearDown(self):
+        auth.JWKS_CACHE, auth.TOKEN_CACHE = self.saved
+        self.server.close()
+
+    def test_repeated_token_is_verified_once(self):
+        token = make_token(self.pem, 'key-1', ['get:actors'])
+        first = verify_decode_jwt_cached(token)
+        second = verify_decode_jwt_cached(token)
+        self.assertEqual(first, second)
+        self.assertEqual(auth.TOKEN_CACHE.hits, 1)
+        self.assertEqual(auth.TOKEN_CACHE.misses, 1)
+
+    def test_entry_expires_at_exp(self):
+        cache = VerifiedTokenCache()
+        cache.put('token', {'exp': time.time() - 1}, 1)
+        self.assertIsNone(cache.get('token', 1))
+        cache.put('token', {'permissions': []}, 1)
+        self.assertIsNone(cache.get('token', 1))
+
+    def test_bounded_lru(self):
+        cache = VerifiedTokenCache(2)
+        exp = time.time() + 60
+        cache.put('a', {'exp': exp}, 1)
+        cache.put('b', {'exp': exp}, 1)
+        cache.get('a', 1)
+        cache.put('c', {'exp': exp}, 1)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b', 1))
+        self.assertIsNotNone(cache.get('a', 1))
+
+    def test_key_rotation_invalidates(self):
+        token = make_token(self.pem, 'key-1')
+        verify_decode_jwt_cached(token)
+
+        # key-1 is revoked at the identity provider
+        self.server.jwks = {'keys': [self.jwk2]}
+        auth.JWKS_CACHE._expires_at = 0
+        with self.assertRaises(AuthError):
+            verify_decode_jwt_cached(token)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+
+from cache import CacheBackend, LRUBackend, ResponseCache, ItemCache
+
+class FakeSharedBackend(CacheBackend):
+    #
+    # Stands in for a shared backend such as redis, a plain dict
+    #
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+class BrokenBackend(CacheBackend):
+    def get(self, key):
+        raise ConnectionError()
+
+    def set(self, key, value):
+        raise ConnectionError()
+
+class LRUBackendTestCase(unittest.TestCase):
+
+    def test_evicts_least_recently_used_by_size(self):
+        backend = LRUBackend(max_bytes=10)
+        backend.set('a', b'1234')
+        backend.set('b', b'1234')
+        backend.get('a')
+        backend.set('c', b'1234')
+        self.assertEqual(backend.size, 8)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'1234')
+
+    def test_value_larger_than_cache_is_not_stored(self):
+        backend = LRUBackend(max_bytes=2)
+        backend.set('a', b'1234')
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.size, 0)
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def test_new_version_makes_old_entries_unreachable(self):
+        for backend in (LRUBackend(), FakeSharedBackend()):
+            cache = ResponseCache(backend)
+            key = cache.key('actors', 1, 'limit=2')
+            cache.set(key, b'{}')
+            self.assertEqual(cache.get(key), b'{}')
+
+            # a write committed by any worker bumped the version
+            self.assertIsNone(cache.get(cache.key('actors', 2, 'limit=2')))
+
+    def test_stats(self):
+        cache = ResponseCache(LRUBackend())
+        cache.set('k', b'12345')
+        cache.get('k')
+        cache.get('missing')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+        self.assertEqual(stats['bytes'], 5)
+
+    def test_backend_errors_are_misses(self):
+        cache = ResponseCache(BrokenBackend())
+        self.assertIsNone(cache.get('k'))
+        cache.set('k', b'{}')
+
+    def test_disabled(self):
+        self.assertFalse(ResponseCache(None).enabled())
+        self.assertTrue(ResponseCache(LRUBackend()).enabled())
+
+class ItemCacheTestCase(unittest.TestCase):
+
+    def test_invalidate_ids(self):
+        cache = ItemCache()
+        cache.set('actors', 1, {'id': 1}, cache.generation('actors'))
+        cache.set('actors', 2, {'id': 2}, cache.generation('actors'))
+        cache.invalidate({'actors': {1}})
+        self.assertIsNone(cache.get('actors', 1))
+        self.assertEqual(cache.get('actors', 2), {'id': 2})
+
+        cache.invalidate({'actors': None})
+        self.assertIsNone(cache.get('actors', 2))
+
+    def test_stale_read_is_not_stored(self):
+        cache = ItemCache()
+        generation = cache.generation('movies')
+        # a write is committed while the movie is being read
+        cache.invalidate({'movies': {1}})
+        cache.set('movies', 1, {'id': 1}, generation)
+        self.assertIsNone(cache.get('movies', 1))
+
+    def test_age(self):
+        cache = ItemCache()
+        self.assertEqual(cache.age('actors'), float('inf'))
+        cache.invalidate({'actors': {1}})
+        self.assertLess(cache.age('actors'), 1)
+
+    def test_ttl_and_size(self):
+        cache = ItemCache(maxsize=1, ttl=0)
+        cache.set('actors', 1, {'id': 1}, 0)
+        self.assertIsNone(cache.get('actors', 1))
+
+        cache = ItemCache(maxsize=1, ttl=60)
+        cache.set('actors', 1, {'id': 1}, 0)
+        cache.set('actors', 2, {'id': 2}, 0)
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get('actors', 1))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
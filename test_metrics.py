@@ -0,0 +1,65 @@
+import unittest
+from flask import Flask, g
+
+import metrics
+from metrics import Histogram, Gauge, Registry, timed, start_request, \
+    record_statement, end_request
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_render_cumulative_buckets(self):
+        h = Histogram('latency', 'Latency.', ['route'], (0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            h.observe(value, '/actors')
+        lines = h.render()
+        self.assertIn('# TYPE latency histogram', lines)
+        self.assertIn('latency_bucket{route="/actors",le="0.1"} 1', lines)
+        self.assertIn('latency_bucket{route="/actors",le="1"} 3', lines)
+        self.assertIn('latency_bucket{route="/actors",le="+Inf"} 4', lines)
+        self.assertIn('latency_sum{route="/actors"} 6.05', lines)
+        self.assertIn('latency_count{route="/actors"} 4', lines)
+
+    def test_label_values_are_escaped(self):
+        gauge = Gauge('slowest', 'Slowest.', ['statement'],
+                      lambda: [(('SELECT "a"\n',), 1.5)])
+        self.assertIn('slowest{statement="SELECT \\"a\\"\\n"} 1.5', gauge.render())
+
+class RequestMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        metrics.METRICS.clear()
+        metrics.SLOWEST_STATEMENTS.clear()
+
+    def test_request_is_observed_per_route(self):
+        with self.app.test_request_context('/actors'):
+            start_request()
+            with timed('auth_verify'):
+                pass
+            record_statement(0.002, 'SELECT 1')
+            record_statement(0.005, 'SELECT  2')
+            end_request('/actors', 'GET', 200)
+
+        text = metrics.METRICS.render()
+        self.assertIn('capstone_request_duration_seconds_count{route="/actors",method="GET",status="200"} 1', text)
+        self.assertIn('capstone_request_phase_seconds_count{route="/actors",method="GET",phase="auth_verify"} 1', text)
+        self.assertIn('capstone_sql_queries_per_request_sum{route="/actors",method="GET"} 2', text)
+        self.assertIn('statement="SELECT 2"} 0.005', text)
+
+    def test_disabled(self):
+        metrics.METRICS.enabled = False
+        try:
+            with self.app.test_request_context('/actors'):
+                start_request()
+                with timed('auth_verify'):
+                    pass
+                end_request('/actors', 'GET', 200)
+                self.assertIsNone(g.get('metrics_phases'))
+        finally:
+            metrics.METRICS.enabled = True
+        self.assertNotIn('route="/actors"', metrics.METRICS.render())
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import time
+import pstats
+import tempfile
+import unittest
+from collections import Counter
+
+from profiling import RequestProfiler
+
+def slow_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    if environ['PATH_INFO'] == '/slow':
+        busy(0.05)
+    return [b'ok']
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def call(app, path):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', 'QUERY_STRING': ''}
+    return b''.join(app(environ, lambda status, headers, exc_info=None: None))
+
+class RequestProfilerTestCase(unittest.TestCase):
+
+    def test_only_slow_requests_are_kept(self):
+        profiler = RequestProfiler(slow_app, threshold_ms=20, sample_rate=0, interval_ms=1)
+        call(profiler, '/fast')
+        self.assertEqual(call(profiler, '/slow'), b'ok')
+        profiles = profiler.list()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['path'], '/slow')
+        self.assertEqual(profiles[0]['formats'], ['collapsed'])
+
+        collapsed = profiler.get(profiles[0]['id']).collapsed()
+        self.assertIn('busy (', collapsed)
+        # stacks start at the middleware
+        self.assertTrue(collapsed.startswith('__call__ ('))
+
+    def test_sampled_requests_have_pstats(self):
+        profiler = RequestProfiler(slow_app, threshold_ms=0, sample_rate=1)
+        call(profiler, '/fast')
+        profile = profiler.get(profiler.list()[0]['id'])
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(profile.pstats())
+        try:
+            stats = pstats.Stats(f.name)
+            self.assertTrue(any(func[2] == 'slow_app' for func in stats.stats))
+        finally:
+            os.unlink(f.name)
+
+    def test_ring_buffer(self):
+        profiler = RequestProfiler(slow_app, threshold_ms=0, sample_rate=1, size=2)
+        for i in range(3):
+            call(profiler, '/fast')
+        self.assertEqual([p['id'] for p in profiler.list()], [3, 2])
+        self.assertIsNone(profiler.get(1))
+
+    def test_stacks_only_for_sampled_requests(self):
+        started = []
+        def start(ident, base):
+            started.append(ident)
+            return Counter()
+
+        # the threshold is off and the draw practically never picks a request
+        profiler = RequestProfiler(slow_app, threshold_ms=0, sample_rate=1e-12)
+        profiler.sampler.start = start
+        call(profiler, '/fast')
+        self.assertEqual(started, [])
+        self.assertEqual(profiler.list(), [])
+
+        profiler = RequestProfiler(slow_app, threshold_ms=0, sample_rate=1)
+        profiler.sampler.start = start
+        call(profiler, '/fast')
+        self.assertEqual(len(started), 1)
+        self.assertEqual(len(profiler.list()), 1)
+
+    def test_disabled(self):
+        profiler = RequestProfiler(slow_app, threshold_ms=0, sample_rate=0)
+        call(profiler, '/slow')
+        self.assertEqual(profiler.list(), [])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import json
+import datetime
+import unittest
+from unittest import mock
+
+import serialize
+from serialize import dumps, dumps_with_list
+from models import format_date, GENDER_VALUES
+
+DATA = {
+    'actors': [{
+        'id': 1,
+        'name': 'Zoë "Ångström" \\ \t\n\x00\x1f\x7f 日本 😀',
+        'age': None,
+        'gender': 'F',
+        'movies_id': [3, 1, 2],
+    }, {
+        'id': 2 ** 40,
+        'name': '',
+        'age': -1,
+        'gender': 'M',
+        'movies_id': [],
+    }],
+    'next_cursor': None,
+    'success': True,
+    'total_actors': 2 ** 70,
+}
+
+class DumpsTestCase(unittest.TestCase):
+
+    def expected(self, data):
+        return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+    def test_same_bytes_as_json(self):
+        self.assertEqual(dumps(DATA), self.expected(DATA))
+        self.assertEqual(dumps(DATA['actors'][1]), self.expected(DATA['actors'][1]))
+
+    def test_same_bytes_without_orjson(self):
+        with mock.patch.object(serialize, 'orjson', None):
+            self.assertEqual(dumps(DATA), self.expected(DATA))
+
+    def test_same_bytes_fast_json_off(self):
+        with mock.patch.object(serialize, 'FAST_JSON', False):
+            self.assertEqual(dumps(DATA), self.expected(DATA))
+
+    def test_dumps_with_list(self):
+        items = [dumps(item) for item in DATA['actors']]
+        rest = {k: v for k, v in DATA.items() if k != 'actors'}
+        self.assertEqual(dumps_with_list('actors', items, rest), self.expected(DATA))
+        self.assertEqual(dumps_with_list('actors', [], {}), b'{"actors":[]}')
+        self.assertEqual(dumps_with_list('actors', items[:1], {'success': True}),
+                         self.expected({'actors': DATA['actors'][:1], 'success': True}))
+
+class FormatTestCase(unittest.TestCase):
+
+    def test_format_date(self):
+        date = datetime.date(2020, 3, 28)
+        self.assertEqual(format_date(date), '20200328')
+        self.assertEqual(format_date(date), date.strftime('%Y%m%d'))
+
+    def test_gender_values(self):
+        self.assertEqual(GENDER_VALUES, {'male': 'M', 'female': 'F'})
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()